@@ -0,0 +1,258 @@
+"""Static analysis of a rom: reachable code, data, control flow graph and pre-decoded program image
+
+Usage: python analyzer.py ROM [--listing] [--dot FILE] [--no-cache]
+
+The code is found by following every path from the entry point (0x200): jumps, calls and the return address after
+them, both outcomes of skips, and the base address of JP V0 (its real targets depend on V0 and are not followed). The
+bytes of the rom that no path reaches as an instruction are data, and the addresses loaded into I (LD I, nnn) that
+fall in the rom are the likely sprites. The code is split into basic blocks (straight-line code entered at its first
+instruction only) that form the control flow graph.
+
+The result, a ProgramImage, is cached on disk (in CACHE_DIR, by the sha1 of the rom) and can be loaded into a
+Chip8State with load_program_image, so that the instructions of the rom are decoded once instead of every run.
+"""
+import argparse
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+from instructions import INSTRUCTION_IDS, INSTRUCTION_NAMES, decode
+from roms import read_rom
+
+# Bumped whenever the analysis changes, so that older cached images are analysed again
+ANALYZER_VERSION = 1
+CACHE_DIR = os.environ.get('CHIP8_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'chip8'))
+
+_JP = INSTRUCTION_IDS['JP']
+_CALL = INSTRUCTION_IDS['CALL']
+_RET = INSTRUCTION_IDS['RET']
+_SYS = INSTRUCTION_IDS['SYS']
+_JP_V0 = INSTRUCTION_IDS['JP_V0']
+_LD_I = INSTRUCTION_IDS['LD_I']
+_SKIP_IDS = {INSTRUCTION_IDS[name] for name in ('SE_Vx', 'SNE_Vx', 'SE_Vy_Vy', 'SNE_Vx_Vy', 'SKP_Vx', 'SKNP_Vx')}
+
+# start and end (address of the last instruction) of a basic block, and the start addresses of the blocks that can
+# run after it
+BasicBlock = namedtuple('BasicBlock', ['start', 'end', 'successors'])
+
+# rom: the rom bytes, loaded at base
+# code: {address: opcode} of every reachable instruction
+# decoded: {opcode: decode table entry} of the opcodes in code (see instructions.decode)
+# blocks: {start address: BasicBlock}
+# subroutines: sorted addresses called by CALL
+# sprites: sorted addresses in the rom loaded into I by LD I, nnn
+# indirect_jumps: sorted addresses of the JP V0 instructions, whose targets are only known at run time
+# invalid: sorted addresses reached by a path that do not hold a valid instruction
+ProgramImage = namedtuple('ProgramImage', ['rom', 'sha1', 'base', 'code', 'decoded', 'blocks', 'subroutines',
+                                           'sprites', 'indirect_jumps', 'invalid'])
+
+
+def _successors(address, entry):
+    # Addresses that can be executed right after the instruction at address
+    inst_id, nnn = entry[0], entry[5]
+    if inst_id in (_JP, _JP_V0):
+        return [nnn]
+    if inst_id == _CALL:
+        return [nnn, address + 2]
+    if inst_id == _RET:
+        return []
+    if inst_id == _SYS:
+        # Chip8State does not move the pc on SYS, it never gets past it
+        return []
+    if inst_id in _SKIP_IDS:
+        return [address + 2, address + 4]
+    return [address + 2]
+
+
+def _ends_block(entry):
+    inst_id = entry[0]
+    return inst_id in (_JP, _JP_V0, _CALL, _RET, _SYS) or inst_id in _SKIP_IDS
+
+
+def analyze(rom, base=0x200):
+    """Analyses rom (bytes) loaded at base and returns its ProgramImage"""
+    end = base + len(rom)
+
+    def opcode_at(address):
+        return (rom[address - base] << 8) | rom[address - base + 1]
+
+    code = {}
+    decoded = {}
+    subroutines = set()
+    sprites = set()
+    indirect_jumps = set()
+    invalid = set()
+    # Addresses where a block has to start: the entry point and every branch target
+    leaders = {base}
+
+    pending = [base]
+    while pending:
+        address = pending.pop()
+        if address in code or address in invalid:
+            continue
+        if not base <= address < end - 1:
+            # Outside of the rom (or its last byte): nothing known to execute there
+            invalid.add(address)
+            continue
+        opcode = opcode_at(address)
+        entry = decoded.get(opcode) or decode(opcode)
+        if entry is None:
+            invalid.add(address)
+            continue
+        code[address] = opcode
+        decoded[opcode] = entry
+
+        inst_id = entry[0]
+        if inst_id == _CALL:
+            subroutines.add(entry[5])
+        elif inst_id == _JP_V0:
+            indirect_jumps.add(address)
+        elif inst_id == _LD_I and base <= entry[5] < end:
+            sprites.add(entry[5])
+        successors = _successors(address, entry)
+        if _ends_block(entry):
+            leaders.update(successors)
+        pending.extend(successors)
+
+    # Split the code in basic blocks: from a leader up to the first instruction that branches, or right before the
+    # next leader
+    blocks = {}
+    for start in sorted(leaders):
+        if start not in code:
+            continue
+        address = start
+        while True:
+            entry = decoded[code[address]]
+            if _ends_block(entry):
+                successors = _successors(address, entry)
+                break
+            following = address + 2
+            if following in leaders or following not in code:
+                successors = [following]
+                break
+            address = following
+        blocks[start] = BasicBlock(start, address, sorted(set(successors)))
+
+    return ProgramImage(rom, hashlib.sha1(rom).hexdigest(), base, code, decoded, blocks, sorted(subroutines),
+                        sorted(sprites), sorted(indirect_jumps), sorted(invalid))
+
+
+def _to_json(image):
+    return {
+        'version': ANALYZER_VERSION,
+        'sha1': image.sha1,
+        'base': image.base,
+        'code': {str(address): opcode for address, opcode in image.code.items()},
+        'decoded': {str(opcode): list(entry) for opcode, entry in image.decoded.items()},
+        'blocks': [list(block) for block in image.blocks.values()],
+        'subroutines': image.subroutines,
+        'sprites': image.sprites,
+        'indirect_jumps': image.indirect_jumps,
+        'invalid': image.invalid,
+    }
+
+
+def _from_json(data, rom):
+    return ProgramImage(
+        rom, data['sha1'], data['base'],
+        {int(address): opcode for address, opcode in data['code'].items()},
+        {int(opcode): tuple(entry) for opcode, entry in data['decoded'].items()},
+        {start: BasicBlock(start, end, successors) for start, end, successors in data['blocks']},
+        data['subroutines'], data['sprites'], data['indirect_jumps'], data['invalid'])
+
+
+def cache_path(rom, base=0x200, cache_dir=None):
+    return os.path.join(cache_dir or CACHE_DIR, '{}-{:03x}.json'.format(hashlib.sha1(rom).hexdigest(), base))
+
+
+def load_image(rom, base=0x200, cache_dir=None, use_cache=True):
+    """Returns the ProgramImage of rom, from the disk cache if it was analysed before (and caching it otherwise)"""
+    path = cache_path(rom, base, cache_dir)
+    if use_cache:
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == ANALYZER_VERSION:
+                return _from_json(data, rom)
+        except (OSError, ValueError, KeyError):
+            # Missing or unreadable: analyse again
+            pass
+
+    image = analyze(rom, base)
+    if use_cache:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written next to its final name and renamed, so a concurrent reader never sees half a file
+            with open(path + '.tmp', 'w') as f:
+                json.dump(_to_json(image), f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            # The cache is an optimisation only
+            pass
+    return image
+
+
+def format_listing(image):
+    """Returns a disassembly of the code, block by block, followed by the data bytes"""
+    lines = []
+    subroutines = set(image.subroutines)
+    for block in image.blocks.values():
+        label = 'sub' if block.start in subroutines else 'block'
+        lines.append('{}_{:03x}:'.format(label, block.start))
+        for address in range(block.start, block.end + 2, 2):
+            opcode = image.code[address]
+            name = INSTRUCTION_NAMES[image.decoded[opcode][0]]
+            lines.append('    0x{:03x}  {:04x}  {}'.format(address, opcode, name))
+        lines.append('    -> {}'.format(', '.join('0x{:03x}'.format(successor) for successor in block.successors)
+                                        or 'none'))
+
+    code_bytes = set(image.code) | {address + 1 for address in image.code}
+    data = [address for address in range(image.base, image.base + len(image.rom)) if address not in code_bytes]
+    lines.append('data ({} bytes):'.format(len(data)))
+    for address in data:
+        marker = '  <- sprite' if address in image.sprites else ''
+        lines.append('    0x{:03x}  {:02x}{}'.format(address, image.rom[address - image.base], marker))
+    return '\n'.join(lines)
+
+
+def format_dot(image):
+    """Returns the control flow graph in the Graphviz dot format"""
+    lines = ['digraph cfg {', '    node [shape=box, fontname=monospace];']
+    for block in image.blocks.values():
+        lines.append('    b{0:03x} [label="0x{0:03x}-0x{1:03x}"];'.format(block.start, block.end))
+        for successor in block.successors:
+            if successor in image.blocks:
+                lines.append('    b{:03x} -> b{:03x};'.format(block.start, successor))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyse the code and data of a CHIP-8 rom')
+    parser.add_argument('rom', help='path to a rom or name of one of the roms in ROMS/')
+    parser.add_argument('--listing', action='store_true', help='print the disassembly and the data bytes')
+    parser.add_argument('--dot', help='write the control flow graph to this file (Graphviz dot)')
+    parser.add_argument('--no-cache', action='store_true', help='neither read nor write the disk cache')
+    args = parser.parse_args(argv)
+
+    image = load_image(read_rom(args.rom), use_cache=not args.no_cache)
+    code_bytes = 2 * len(image.code)
+    print('rom: {} bytes, sha1 {}'.format(len(image.rom), image.sha1))
+    print('code: {} instructions ({} bytes), {} distinct opcodes'.format(len(image.code), code_bytes,
+                                                                        len(image.decoded)))
+    print('data: {} bytes, {} sprites'.format(len(image.rom) - code_bytes, len(image.sprites)))
+    print('basic blocks: {}, subroutines: {}'.format(len(image.blocks), len(image.subroutines)))
+    if image.indirect_jumps:
+        print('indirect jumps (JP V0) at: {}'.format(', '.join('0x{:03x}'.format(a) for a in image.indirect_jumps)))
+    if image.invalid:
+        print('invalid targets: {}'.format(', '.join('0x{:03x}'.format(a) for a in image.invalid)))
+    if args.listing:
+        print(format_listing(image))
+    if args.dot:
+        with open(args.dot, 'w') as f:
+            f.write(format_dot(image))
+
+
+if __name__ == '__main__':
+    main()
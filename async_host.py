@@ -0,0 +1,234 @@
+"""Hosts many emulator sessions in one process, as coroutines of one asyncio event loop
+
+Usage: python async_host.py ROM [--sessions N] [--seconds S] [--ips N] [--engine ENGINE] [--fusion] [--keys KEYS]
+
+A Session runs one Chip8State in real time: its clock coroutine sleeps until every 60 Hz frame deadline, applies the
+keypad masks waiting in its inputs queue, emulates the frames due (batches of instructions plus a timer tick, see
+scheduler.Scheduler) and offers the display to its frame sinks whenever it changes. Sessions keep their own deadlines
+and instructions per second, and never block: the event loop interleaves them a frame at a time.
+
+Inputs and outputs are asyncio queues, so a session can be driven by anything that runs on the loop: a socket, a
+recorded script (play_script), another session. A frame sink is a bounded queue. When it is full, the oldest frame in
+it is dropped, so a slow consumer only ever misses frames and never holds up the session.
+
+The command line runs SESSIONS sessions of ROM at once, each one pressing KEYS in turn (a comma separated list of hex
+keys), and reports how well they kept up with real time.
+"""
+import argparse
+import asyncio
+import time
+
+from chip8 import Chip8State
+from headless import ENGINES, INPUT_PERIOD, scripted_inputs
+from roms import read_rom
+from scheduler import DEFAULT_INSTRUCTIONS_PER_SECOND, TIMER_HZ, FrameLag, Scheduler
+
+
+class Session:
+    """One emulated machine run in real time by its run coroutine
+
+    Keypad masks (16 bit, bit k set if key k is pressed) put in inputs are applied in order at the start of the next
+    frame. Frames go to the queues returned by add_sink as (frame_count, framebuffer bytes) tuples, followed by None
+    when the session ends.
+    """
+
+    def __init__(self, chip8, instructions_per_second=DEFAULT_INSTRUCTIONS_PER_SECOND, engine=None, name=None,
+                 max_lag_frames=5):
+        self.chip8 = chip8
+        self.scheduler = Scheduler(chip8, instructions_per_second, engine=engine)
+        self.name = name
+        # How late the frames of the session started
+        self.frame_lag = FrameLag(1 / TIMER_HZ, max_lag_frames)
+        self.inputs = asyncio.Queue()
+        self._sinks = []
+        # (cycle, future) of the coroutines waiting in until_cycle
+        self._cycle_waiters = []
+
+    def add_sink(self, maxsize=1):
+        """Returns a new queue receiving the frames, holding the latest maxsize of them"""
+        # Unbounded, the frames are limited by _send so that the end marker never pushes out the last frame
+        sink = asyncio.Queue()
+        self._sinks.append((sink, maxsize))
+        return sink
+
+    def remove_sink(self, sink):
+        self._sinks = [(queue, maxsize) for queue, maxsize in self._sinks if queue is not sink]
+
+    async def until_cycle(self, cycle):
+        """Waits until the session has executed cycle instructions (checked at the end of every frame)"""
+        if self.chip8.cycle_count >= cycle:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._cycle_waiters.append((cycle, future))
+        await future
+
+    async def run(self, seconds=None):
+        """Runs the session in real time, for the given number of seconds or until it is cancelled"""
+        loop = asyncio.get_running_loop()
+        chip8 = self.chip8
+        scheduler = self.scheduler
+        frame_lag = self.frame_lag
+        period = frame_lag.period
+        start = last = deadline = loop.time()
+        # Display generation last sent to the sinks, -1 so that the first frame is always sent
+        sent_generation = -1
+        try:
+            while seconds is None or last - start < seconds:
+                deadline += period
+                # Sleeps 0 if late, which still lets the other sessions run
+                await asyncio.sleep(max(deadline - loop.time(), 0))
+                now = loop.time()
+                if frame_lag.record_lag(now - deadline):
+                    deadline = now
+
+                inputs = self.inputs
+                while not inputs.empty():
+                    # In order, so that a press and a release within one frame still wake a machine waiting for a key
+                    chip8.set_keypad_mask(inputs.get_nowait())
+                scheduler.advance(now - last)
+                last = now
+                if self._cycle_waiters:
+                    self._wake_cycle_waiters()
+                if chip8.display_generation != sent_generation:
+                    self._send((scheduler.frame_count, chip8.framebuffer_bytes()))
+                    sent_generation = chip8.display_generation
+        finally:
+            self._send(None)
+
+    def _wake_cycle_waiters(self):
+        cycle_count = self.chip8.cycle_count
+        waiting = []
+        for cycle, future in self._cycle_waiters:
+            if future.done():
+                continue
+            if cycle <= cycle_count:
+                future.set_result(None)
+            else:
+                waiting.append((cycle, future))
+        self._cycle_waiters = waiting
+
+    def _send(self, frame):
+        for sink, maxsize in self._sinks:
+            if frame is not None:
+                while sink.qsize() >= maxsize:
+                    sink.get_nowait()
+            sink.put_nowait(frame)
+
+
+async def feed(session, source):
+    """Puts every keypad mask of an async iterable (e.g. read from a socket) in the inputs of session"""
+    async for mask in source:
+        await session.inputs.put(mask)
+
+
+async def play_script(session, inputs):
+    """Plays (cycle, keypad_mask) pairs sorted by cycle (see headless.run_with_inputs) into session
+
+    A mask is applied at the start of the frame after the one its cycle falls in, so the timing is only as fine as a
+    frame.
+    """
+    for cycle, mask in inputs:
+        await session.until_cycle(cycle)
+        session.inputs.put_nowait(mask)
+
+
+async def frames_of(sink):
+    """Yields the frames of a sink (see Session.add_sink) until its session ends"""
+    while True:
+        frame = await sink.get()
+        if frame is None:
+            return
+        yield frame
+
+
+class Host:
+    """Runs any number of sessions as tasks of the running event loop"""
+
+    def __init__(self):
+        # session: task running it
+        self.sessions = {}
+
+    def start(self, session, seconds=None):
+        task = asyncio.get_running_loop().create_task(session.run(seconds), name=session.name)
+        self.sessions[session] = task
+        task.add_done_callback(lambda _: self.sessions.pop(session, None))
+        return task
+
+    async def wait(self):
+        """Waits until every session has ended. Raises the first exception a session ended with"""
+        await asyncio.gather(*self.sessions.values())
+
+    async def stop(self):
+        """Cancels every session and waits for them to end"""
+        tasks = list(self.sessions.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _count_frames(sink):
+    count = 0
+    async for _ in frames_of(sink):
+        count += 1
+    return count
+
+
+async def host_sessions(rom_bytes, sessions, seconds, instructions_per_second=DEFAULT_INSTRUCTIONS_PER_SECOND,
+                        engine='interpreter', fusion=False, keys=(1, 4), input_period=INPUT_PERIOD):
+    """Runs sessions sessions of a rom for seconds, each one with the same scripted input. Returns the sessions and
+    the number of frames each one sent to a sink"""
+    host = Host()
+    running = []
+    counters = []
+    scripts = []
+    cycles = int(seconds * instructions_per_second)
+    for i in range(sessions):
+        chip8 = Chip8State()
+        chip8.initialise(i)
+        chip8.load_rom(rom_bytes)
+        chip8.fusion = fusion
+        session = Session(chip8, instructions_per_second, ENGINES[engine](chip8), name='session-{}'.format(i))
+        counters.append(asyncio.ensure_future(_count_frames(session.add_sink())))
+        scripts.append(asyncio.ensure_future(play_script(session, scripted_inputs(keys, cycles, input_period))))
+        running.append(session)
+        host.start(session, seconds)
+    await host.wait()
+    for script in scripts:
+        # Still waiting if its session ended before the last cycle of the script
+        script.cancel()
+    sent = await asyncio.gather(*counters)
+    return running, sent
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run many sessions of a CHIP-8 rom in real time in one process')
+    parser.add_argument('rom', help='path to a rom or name of one of the roms in ROMS/')
+    parser.add_argument('--sessions', type=int, default=100, help='number of sessions (default: %(default)s)')
+    parser.add_argument('--seconds', type=float, default=5.0, help='real time to run for (default: %(default)s)')
+    parser.add_argument('--ips', type=int, default=DEFAULT_INSTRUCTIONS_PER_SECOND,
+                        help='emulated instructions per second of every session (default: %(default)s)')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='interpreter')
+    parser.add_argument('--fusion', action='store_true', help='turn on the superinstructions of the interpreter')
+    parser.add_argument('--keys', default='1,4',
+                        help='hex keys pressed in turn by every session (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    keys = tuple(int(key, 16) for key in args.keys.split(','))
+    start = time.perf_counter()
+    sessions, sent = asyncio.run(host_sessions(read_rom(args.rom), args.sessions, args.seconds, args.ips, args.engine,
+                                               args.fusion, keys))
+    seconds = time.perf_counter() - start
+
+    frames = sum(session.scheduler.frame_count for session in sessions)
+    expected = args.sessions * args.seconds * TIMER_HZ
+    cycles = sum(session.chip8.cycle_count for session in sessions)
+    print('{} sessions, {:.2f} s: {} emulated frames ({:.1%} of real time), {:.0f} instructions/s in total'.format(
+        len(sessions), seconds, frames, frames / expected, cycles / seconds))
+    print('frames sent: {}, late frames: {}, lag mean {:.2f} ms, max {:.2f} ms'.format(
+        sum(sent), sum(session.frame_lag.late_frames for session in sessions),
+        1000 * sum(session.frame_lag.mean_lag for session in sessions) / len(sessions),
+        1000 * max(session.frame_lag.max_lag for session in sessions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+"""Steps many CHIP-8 machines in lockstep using NumPy
+
+Every machine state lives in a NumPy array with one row per machine (memory is N x 4096, registers N x 16 and so on).
+A step fetches and decodes the next instruction of every machine, groups the machines by the decoded instruction and
+then runs each instruction once, as a vectorized operation over its group. Instructions behave like the ones of
+Chip8State, so machine i of a batch goes through the same states as a Chip8State running the same rom and input.
+
+Every machine has a random number generator of its own, seeded like the one of Chip8State.initialise, so the RND
+values of a machine only depend on its seed: machine i with seeds[i] = s draws the same numbers as a Chip8State
+initialised with seed s, whatever the other machines of the batch do.
+"""
+import random
+from array import array
+
+import numpy as np
+
+from chip8 import Chip8State, FONTSET_BYTES
+from instructions import get_decode_table
+
+# Instruction id of every opcode (-1 for invalid opcodes), see instructions.get_decode_table
+_decode_ids = None
+
+
+def get_decode_ids():
+    global _decode_ids
+    if _decode_ids is None:
+        _decode_ids = np.array([-1 if entry is None else entry[0] for entry in get_decode_table()], dtype=np.int8)
+    return _decode_ids
+
+
+class Chip8Batch:
+    def __init__(self, count, seeds=None):
+        """seeds holds the seed of the random number generator of every machine (None seeds them all from the os)"""
+        if seeds is not None and len(seeds) != count:
+            raise ValueError('{} seeds for {} machines'.format(len(seeds), count))
+        self.count = count
+        self.width, self.height = 64, 32  # in pixels
+        self.fontset_loc = 0
+
+        # One row per machine. uint8 and uint16 arrays wrap around on overflow, just like the real registers
+        self.memory = np.zeros((count, 4096), dtype=np.uint8)
+        self.gen_regs = np.zeros((count, 16), dtype=np.uint8)
+        self.index_reg = np.zeros(count, dtype=np.uint16)
+        self.pc_reg = np.full(count, 512, dtype=np.uint16)
+        self.sp_reg = np.full(count, -1, dtype=np.int16)
+        self.stack = np.zeros((count, 16), dtype=np.uint16)
+        self.keypad = np.zeros((count, 16), dtype=np.uint8)
+        # Register waiting for a key press (LD_Vx_K) of every machine, -1 if not waiting (see Chip8State.key_wait)
+        self.key_wait = np.full(count, -1, dtype=np.int8)
+        self.delay_timer = np.zeros(count, dtype=np.uint8)
+        self.sound_timer = np.zeros(count, dtype=np.uint8)
+        # 32 packed rows of 64 pixels per machine, the most significant bit is the leftmost pixel (as in Chip8State)
+        self.display = np.zeros((count, 32), dtype=np.uint64)
+        self.display_generation = np.zeros(count, dtype=np.int64)
+        self.cycle_count = 0
+
+        self.memory[:, self.fontset_loc: self.fontset_loc + len(FONTSET_BYTES)] = np.frombuffer(FONTSET_BYTES,
+                                                                                              dtype=np.uint8)
+        self.seeds = [None] * count if seeds is None else list(seeds)
+        self.rngs = [random.Random(seed) for seed in self.seeds]
+        self._all = np.arange(count)
+
+        # Vectorized instruction handlers indexed by instruction id (same order as INSTRUCTION_NAMES)
+        self._handlers = [
+            self._cls, self._ret, self._sys, self._jp, self._call, self._se_vx, self._sne_vx, self._se_vx_vy,
+            self._ld_vx, self._add_vx, self._ld_vx_vy, self._or_vx_vy, self._and_vx_vy, self._xor_vx_vy,
+            self._add_vx_vy, self._sub_vx_vy, self._shr_vx_vy, self._subn_vx_vy, self._shl_vx_vy, self._sne_vx_vy,
+            self._ld_i, self._jp_v0, self._rnd_vx, self._drw_vx_vy, self._skp_vx, self._sknp_vx, self._ld_vx_dt,
+            self._ld_vx_k, self._ld_dt_vx, self._ld_st_vx, self._add_i_vx, self._ld_f_vx, self._ld_b_vx,
+            self._ld_i_vx, self._ld_vx_i,
+        ]
+
+    def load_rom(self, rom, machines=None):
+        """Loads the rom into every machine, or only into the given machine indices"""
+        if 512 + len(rom) > self.memory.shape[1]:
+            raise ValueError('rom of {} bytes does not fit in memory'.format(len(rom)))
+        rows = self._all if machines is None else machines
+        self.memory[rows, 512: 512 + len(rom)] = np.frombuffer(rom, dtype=np.uint8)
+
+    def set_keypad_mask(self, machines, mask):
+        """Sets the keypad of the given machine indices from a 16 bit mask (bit k set if key k is pressed), or from one
+        mask per machine
+
+        Like Chip8State.set_keypad_mask, a machine waiting for a key (LD_Vx_K) stops waiting if a key is now pressed.
+        """
+        masks = np.asarray(mask, dtype=np.uint16)
+        self.keypad[machines] = (masks[..., np.newaxis] >> np.arange(16, dtype=np.uint16)) & 1
+        self._wake(np.asarray(machines, dtype=np.intp).reshape(-1))
+
+    def _wake(self, machines):
+        # Same as Chip8State.waiting_for_key for the waiting machines among machines: the ones with a pressed key
+        # store the lowest one in the waiting register and move past the LD_Vx_K instruction, without executing it
+        waiting = machines[self.key_wait[machines] >= 0]
+        ready = waiting[self.keypad[waiting].any(axis=1)]
+        # argmax returns the first (lowest) pressed key
+        self.gen_regs[ready, self.key_wait[ready]] = self.keypad[ready].argmax(axis=1)
+        self.key_wait[ready] = -1
+        self._next(ready)
+
+    def tick_timers(self):
+        """Decrements the delay and sound timers of every machine. Has to be called 60 times per emulated second"""
+        self.delay_timer[self.delay_timer > 0] -= 1
+        self.sound_timer[self.sound_timer > 0] -= 1
+
+    def run(self, cycles):
+        """Executes the given number of instructions on every machine
+
+        As in Chip8State.run, a machine waiting for a key first stops waiting if one is pressed. The ones still waiting
+        execute LD_Vx_K again at every step, which does nothing but use the cycle.
+        """
+        if (self.key_wait >= 0).any():
+            self._wake(self._all)
+        for _ in range(cycles):
+            self.step()
+
+    def step(self):
+        """Executes one instruction on every machine"""
+        pc = self.pc_reg.astype(np.intp)
+        opcodes = (self.memory[self._all, pc].astype(np.uint16) << 8) | self.memory[self._all, pc + 1]
+        inst_ids = get_decode_ids()[opcodes]
+        invalid = np.flatnonzero(inst_ids < 0)
+        if len(invalid):
+            raise ValueError('opcode {} is not a valid instruction'.format(int(opcodes[invalid[0]])))
+
+        x = ((opcodes & 0x0F00) >> 8).astype(np.intp)
+        y = ((opcodes & 0x00F0) >> 4).astype(np.intp)
+        n = (opcodes & 0x000F).astype(np.intp)
+        kk = (opcodes & 0x00FF).astype(np.uint8)
+        nnn = opcodes & 0x0FFF
+
+        # Group the machines by instruction: sort the machine indices by instruction id and cut where the id changes
+        order = np.argsort(inst_ids, kind='stable')
+        bounds = np.flatnonzero(np.diff(inst_ids[order])) + 1
+        for idx in np.split(order, bounds):
+            self._handlers[inst_ids[idx[0]]](idx, x[idx], y[idx], n[idx], kk[idx], nnn[idx])
+        self.cycle_count += 1
+
+    def framebuffer_bytes(self, machine):
+        """Returns the display of a machine in the same format as Chip8State.framebuffer_bytes"""
+        return self.display[machine].astype('>u8').tobytes()
+
+    def to_chip8_state(self, machine):
+        """Returns a Chip8State with a copy of the state of a machine, random number generator included"""
+        chip8 = Chip8State()
+        chip8.initialise()
+        chip8.memory[:] = self.memory[machine].tobytes()
+        chip8.gen_regs[:] = self.gen_regs[machine].tobytes()
+        chip8.index_reg = int(self.index_reg[machine])
+        chip8.pc_reg = int(self.pc_reg[machine])
+        chip8.sp_reg = int(self.sp_reg[machine])
+        chip8.stack[:] = array('H', self.stack[machine].tolist())
+        chip8.keypad[:] = self.keypad[machine].tobytes()
+        chip8.key_wait = None if self.key_wait[machine] < 0 else int(self.key_wait[machine])
+        chip8.delay_timer = int(self.delay_timer[machine])
+        chip8.sound_timer = int(self.sound_timer[machine])
+        chip8.display[:] = array('Q', self.display[machine].tolist())
+        chip8.display_generation = int(self.display_generation[machine])
+        chip8.cycle_count = self.cycle_count
+        chip8.rng.setstate(self.rngs[machine].getstate())
+        return chip8
+
+    # Instruction definitions
+    # Every handler gets the indices of the machines executing the instruction and their operands. Each machine
+    # appears once in idx, so the fancy indexed assignments below never write the same element twice. Handlers read
+    # and write registers in the same order as the Chip8State ones, which matters when x or y is 15 (VF).
+    def _next(self, idx):
+        self.pc_reg[idx] += 2
+
+    def _skip_if(self, idx, condition):
+        self.pc_reg[idx] += np.where(condition, 4, 2).astype(np.uint16)
+
+    def _cls(self, idx, x, y, n, kk, nnn):
+        self.display[idx] = 0
+        self.display_generation[idx] += 1
+        self._next(idx)
+
+    def _ret(self, idx, x, y, n, kk, nnn):
+        # Not incrementing pc by 2
+        self.pc_reg[idx] = self.stack[idx, self.sp_reg[idx]]
+        self.sp_reg[idx] -= 1
+
+    def _sys(self, idx, x, y, n, kk, nnn):
+        # Not implemented, same as Chip8State
+        return
+
+    def _jp(self, idx, x, y, n, kk, nnn):
+        # Not incrementing pc by 2
+        self.pc_reg[idx] = nnn
+
+    def _call(self, idx, x, y, n, kk, nnn):
+        # Not incrementing pc by 2
+        self.sp_reg[idx] += 1
+        self.stack[idx, self.sp_reg[idx]] = self.pc_reg[idx] + 2
+        self.pc_reg[idx] = nnn
+
+    def _se_vx(self, idx, x, y, n, kk, nnn):
+        self._skip_if(idx, self.gen_regs[idx, x] == kk)
+
+    def _sne_vx(self, idx, x, y, n, kk, nnn):
+        self._skip_if(idx, self.gen_regs[idx, x] != kk)
+
+    def _se_vx_vy(self, idx, x, y, n, kk, nnn):
+        self._skip_if(idx, self.gen_regs[idx, x] == self.gen_regs[idx, y])
+
+    def _ld_vx(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, x] = kk
+        self._next(idx)
+
+    def _add_vx(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, x] += kk
+        self._next(idx)
+
+    def _ld_vx_vy(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, x] = self.gen_regs[idx, y]
+        self._next(idx)
+
+    def _or_vx_vy(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, x] |= self.gen_regs[idx, y]
+        self._next(idx)
+
+    def _and_vx_vy(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, x] &= self.gen_regs[idx, y]
+        self._next(idx)
+
+    def _xor_vx_vy(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, x] ^= self.gen_regs[idx, y]
+        self._next(idx)
+
+    def _add_vx_vy(self, idx, x, y, n, kk, nnn):
+        a = self.gen_regs[idx, x].astype(np.uint16) + self.gen_regs[idx, y]
+        self.gen_regs[idx, x] = a & 0xFF
+        self.gen_regs[idx, 15] = a > 0xFF
+        self._next(idx)
+
+    def _sub_vx_vy(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, 15] = self.gen_regs[idx, x] > self.gen_regs[idx, y]
+        self.gen_regs[idx, x] = self.gen_regs[idx, x] - self.gen_regs[idx, y]
+        self._next(idx)
+
+    def _shr_vx_vy(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, 15] = self.gen_regs[idx, x] & 0b1
+        self.gen_regs[idx, x] = self.gen_regs[idx, x] >> 1
+        self._next(idx)
+
+    def _subn_vx_vy(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, 15] = self.gen_regs[idx, y] > self.gen_regs[idx, x]
+        self.gen_regs[idx, x] = self.gen_regs[idx, y] - self.gen_regs[idx, x]
+        self._next(idx)
+
+    def _shl_vx_vy(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, 15] = self.gen_regs[idx, x] >> 7  # Most significant bit is shifted out
+        self.gen_regs[idx, x] = self.gen_regs[idx, x] << 1
+        self._next(idx)
+
+    def _sne_vx_vy(self, idx, x, y, n, kk, nnn):
+        self._skip_if(idx, self.gen_regs[idx, x] != self.gen_regs[idx, y])
+
+    def _ld_i(self, idx, x, y, n, kk, nnn):
+        self.index_reg[idx] = nnn
+        self._next(idx)
+
+    def _jp_v0(self, idx, x, y, n, kk, nnn):
+        # Not incrementing pc by 2
+        self.pc_reg[idx] = nnn + self.gen_regs[idx, 0]
+
+    def _rnd_vx(self, idx, x, y, n, kk, nnn):
+        # Drawn from the generator of each machine, the same way as Chip8State
+        rngs = self.rngs
+        rand = np.array([rngs[machine].getrandbits(8) for machine in idx], dtype=np.uint8)
+        self.gen_regs[idx, x] = rand & kk
+        self._next(idx)
+
+    def _drw_vx_vy(self, idx, x, y, n, kk, nnn):
+        # Same algorithm as Chip8State._drw_vx_vy, one sprite row of every machine at a time
+        x_pos = (self.gen_regs[idx, x] % self.width).astype(np.uint64)
+        y_pos = (self.gen_regs[idx, y] % self.height).astype(np.intp)
+        index = self.index_reg[idx].astype(np.intp)
+        collision = np.zeros(len(idx), dtype=np.uint64)
+        for row_count in range(int(n.max(initial=0))):
+            # Machines that still have a sprite row to draw (the sprite is cut at the end of memory like a slice)
+            drawing = (row_count < n) & (index + row_count < self.memory.shape[1])
+            rows = idx[drawing]
+            sprite = self.memory[rows, index[drawing] + row_count].astype(np.uint64) << np.uint64(56)
+            shift = x_pos[drawing]
+            # Rotate right by x_pos. A shift by 64 is undefined in NumPy, so x_pos == 0 is special cased
+            wrapped = np.where(shift == 0, np.uint64(0), sprite << ((np.uint64(64) - shift) % np.uint64(64)))
+            bits = (sprite >> shift) | wrapped
+            row = (y_pos[drawing] + row_count) % self.height
+            collision[drawing] |= self.display[rows, row] & bits
+            self.display[rows, row] ^= bits
+        self.gen_regs[idx, 15] = collision != 0
+        self.display_generation[idx] += 1
+        self._next(idx)
+
+    def _skp_vx(self, idx, x, y, n, kk, nnn):
+        self._skip_if(idx, self.keypad[idx, self.gen_regs[idx, x]] == 1)
+
+    def _sknp_vx(self, idx, x, y, n, kk, nnn):
+        self._skip_if(idx, self.keypad[idx, self.gen_regs[idx, x]] != 1)
+
+    def _ld_vx_dt(self, idx, x, y, n, kk, nnn):
+        self.gen_regs[idx, x] = self.delay_timer[idx]
+        self._next(idx)
+
+    def _ld_vx_k(self, idx, x, y, n, kk, nnn):
+        # Machines without a pressed key stay on this instruction and wait until one is pressed (see set_keypad_mask),
+        # the others store the lowest pressed key in Vx
+        pressed = self.keypad[idx].any(axis=1)
+        ready = idx[pressed]
+        self.key_wait[idx[~pressed]] = x[~pressed]
+        self.key_wait[ready] = -1
+        # argmax returns the first (lowest) pressed key
+        self.gen_regs[ready, x[pressed]] = self.keypad[ready].argmax(axis=1)
+        self._next(ready)
+
+    def _ld_dt_vx(self, idx, x, y, n, kk, nnn):
+        self.delay_timer[idx] = self.gen_regs[idx, x]
+        self._next(idx)
+
+    def _ld_st_vx(self, idx, x, y, n, kk, nnn):
+        self.sound_timer[idx] = self.gen_regs[idx, x]
+        self._next(idx)
+
+    def _add_i_vx(self, idx, x, y, n, kk, nnn):
+        self.index_reg[idx] += self.gen_regs[idx, x]
+        self._next(idx)
+
+    def _ld_f_vx(self, idx, x, y, n, kk, nnn):
+        self.index_reg[idx] = self.fontset_loc + self.gen_regs[idx, x].astype(np.uint16) * 5
+        self._next(idx)
+
+    def _ld_b_vx(self, idx, x, y, n, kk, nnn):
+        vx = self.gen_regs[idx, x]
+        index = self.index_reg[idx].astype(np.intp)
+        self.memory[idx, index] = (vx // 100) % 10
+        self.memory[idx, index + 1] = (vx // 10) % 10
+        self.memory[idx, index + 2] = vx % 10
+        self._next(idx)
+
+    def _ld_i_vx(self, idx, x, y, n, kk, nnn):
+        index = self.index_reg[idx].astype(np.intp)
+        for i in range(int(x.max()) + 1):
+            storing = i <= x
+            self.memory[idx[storing], index[storing] + i] = self.gen_regs[idx[storing], i]
+        self._next(idx)
+
+    def _ld_vx_i(self, idx, x, y, n, kk, nnn):
+        index = self.index_reg[idx].astype(np.intp)
+        for i in range(int(x.max()) + 1):
+            loading = i <= x
+            self.gen_regs[idx[loading], i] = self.memory[idx[loading], index[loading] + i]
+        self._next(idx)
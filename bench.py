@@ -0,0 +1,201 @@
+"""Benchmarks the emulator on the bundled roms and on synthetic programs, and tracks regressions
+
+Usage: python bench.py [--engine ENGINE] [--fusion] [--repeat N] [--memory] [--output FILE]
+                       [--compare BASELINE [--threshold FRACTION]]
+
+The rom benchmarks run ROMS/PONG, ROMS/TETRIS and ROMS/PongForOne.ch8 headless for a fixed number of cycles, with a
+scripted input that presses the keys of the game in turn. The micro benchmarks run small synthetic programs that are
+dominated by one kind of work (ALU instructions, DRW, CLS), and time the opcode decoding on its own. Every benchmark
+is run repeat times and the fastest run is kept.
+
+The results (instructions per second and nanoseconds per instruction) are printed and, with --output, written as
+JSON. With --memory they also hold the peak of the memory allocated while the benchmark runs, measured by tracemalloc
+in one more run of every benchmark (apart from the timed ones, as tracing the allocations slows it down a lot).
+
+With --compare the results are compared with a JSON file written by an earlier run, and every benchmark that got
+slower by more than the threshold is flagged as a regression (the exit status is then 1).
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from chip8 import Chip8State
+from headless import ENGINES, framebuffer_hash, run_with_inputs, scripted_inputs
+from instructions import get_decode_table
+from roms import read_rom
+from scheduler import DEFAULT_INSTRUCTIONS_PER_SECOND, Scheduler
+
+# name: (rom, cycles, keys pressed in turn by the scripted input)
+ROM_BENCHMARKS = {
+    'PONG': ('PONG', 300000, (1, 4, 0xC, 0xD)),
+    'TETRIS': ('TETRIS', 300000, (4, 5, 6)),
+    'PongForOne': ('PongForOne.ch8', 300000, (1, 4)),
+}
+
+
+def _program(*opcodes):
+    return b''.join(opcode.to_bytes(2, 'big') for opcode in opcodes)
+
+
+# name: (program, cycles). Each program loops forever
+MICRO_BENCHMARKS = {
+    # LD V0, 1; LD V1, 2; then ADD, SUB, AND, XOR, SHL, ADD V0 3, JP 0x204
+    'alu': (_program(0x6001, 0x6102, 0x8014, 0x8015, 0x8012, 0x8013, 0x801E, 0x7003, 0x1204), 1000000),
+    # LD I 0 (the font); then 6 times DRW V0 V1 5, ADD V0 1, JP 0x202
+    'drw': (_program(0xA000, *([0xD015] * 6), 0x7001, 0x1202), 300000),
+    # 7 times CLS, JP 0x200
+    'cls': (_program(*([0x00E0] * 7), 0x1200), 1000000),
+}
+
+# Number of opcodes decoded by the decode benchmark (every opcode, several times over)
+DECODE_COUNT = 65536 * 8
+
+
+def peak_allocated_kb(benchmark):
+    """Runs benchmark once and returns the peak of the memory it allocated (as seen by tracemalloc) in kilobytes"""
+    tracemalloc.start()
+    try:
+        benchmark()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak // 1024
+
+
+def _result(instructions, seconds, **extra):
+    result = {
+        'instructions': instructions,
+        'seconds': seconds,
+        'instructions_per_second': instructions / seconds if seconds > 0 else float('inf'),
+        'ns_per_instruction': 1e9 * seconds / instructions if instructions else 0.0,
+    }
+    result.update(extra)
+    return result
+
+
+def bench_rom(rom, cycles, keys, engine='interpreter', fusion=False):
+    chip8 = Chip8State()
+    # A fixed seed, so that the framebuffer hash only changes with the behaviour of the emulator
+    chip8.initialise(0)
+    chip8.load_rom(read_rom(rom))
+    chip8.fusion = fusion
+    scheduler = Scheduler(chip8, DEFAULT_INSTRUCTIONS_PER_SECOND, engine=ENGINES[engine](chip8))
+    inputs = scripted_inputs(keys, cycles)
+
+    time_start = time.perf_counter()
+    run_with_inputs(chip8, scheduler, inputs, cycles)
+    seconds = time.perf_counter() - time_start
+    # The hash shows when a change altered the behaviour of the emulator rather than its speed
+    return _result(chip8.cycle_count, seconds, framebuffer_hash=framebuffer_hash(chip8))
+
+
+def bench_program(program, cycles, engine='interpreter', fusion=False):
+    chip8 = Chip8State()
+    chip8.initialise()
+    chip8.load_rom(program)
+    chip8.fusion = fusion
+    runner = ENGINES[engine](chip8) or chip8
+
+    time_start = time.perf_counter()
+    runner.run(cycles)
+    seconds = time.perf_counter() - time_start
+    return _result(chip8.cycle_count, seconds)
+
+
+def bench_decode(count=DECODE_COUNT):
+    decode_table = get_decode_table()
+    time_start = time.perf_counter()
+    for opcode in range(count):
+        decode_table[opcode & 0xFFFF]
+    seconds = time.perf_counter() - time_start
+    return _result(count, seconds)
+
+
+def run_benchmarks(engine='interpreter', repeat=3, names=None, fusion=False, memory=False):
+    """Runs the benchmarks (all of them, or the ones in names) and returns {name: result}, keeping the fastest run
+
+    With memory, every benchmark is run once more to measure the peak of the memory it allocates.
+    """
+    benchmarks = {}
+    for name, (rom, cycles, keys) in ROM_BENCHMARKS.items():
+        benchmarks[name] = lambda rom=rom, cycles=cycles, keys=keys: bench_rom(rom, cycles, keys, engine, fusion)
+    for name, (program, cycles) in MICRO_BENCHMARKS.items():
+        benchmarks[name] = lambda program=program, cycles=cycles: bench_program(program, cycles, engine, fusion)
+    benchmarks['decode'] = bench_decode
+
+    # Build the decode table before anything is timed
+    get_decode_table()
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if names and name not in names:
+            continue
+        results[name] = min((benchmark() for _ in range(repeat)), key=lambda result: result['seconds'])
+        if memory:
+            results[name]['peak_allocated_kb'] = peak_allocated_kb(benchmark)
+    return results
+
+
+def compare(results, baseline, threshold=0.05):
+    """Compares results with baseline results and returns a list of (name, baseline ips, ips, change, regression)
+
+    change is the relative change of the instructions per second, a regression is a slowdown larger than threshold.
+    """
+    rows = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['instructions_per_second']
+        after = result['instructions_per_second']
+        change = (after - before) / before
+        rows.append((name, before, after, change, change < -threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the CHIP-8 emulator')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='interpreter',
+                        help='execution engine (default: %(default)s)')
+    parser.add_argument('--fusion', action='store_true', help='turn on the superinstructions of the interpreter')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the fastest is kept '
+                                                              '(default: %(default)s)')
+    parser.add_argument('--memory', action='store_true',
+                        help='also measure the peak memory allocated by each benchmark (one more, much slower run)')
+    parser.add_argument('--only', nargs='+', metavar='NAME', help='run only these benchmarks')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help='slowdown flagged as a regression by --compare (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.engine, args.repeat, args.only, args.fusion, args.memory)
+    print('{:<12} {:>14} {:>10}'.format('benchmark', 'instr/sec', 'ns/instr')
+          + (' {:>16}'.format('peak alloc kB') if args.memory else ''))
+    for name, result in results.items():
+        print('{:<12} {:>14.0f} {:>10.1f}'.format(name, result['instructions_per_second'], result['ns_per_instruction'])
+              + (' {:>16}'.format(result['peak_allocated_kb']) if args.memory else ''))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'engine': args.engine, 'fusion': args.fusion, 'python': platform.python_version(),
+                       'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = 0
+        print()
+        print('{:<12} {:>14} {:>14} {:>8}'.format('benchmark', 'baseline', 'now', 'change'))
+        for name, before, after, change, regression in compare(results, baseline, args.threshold):
+            print('{:<12} {:>14.0f} {:>14.0f} {:>+7.1f}% {}'.format(name, before, after, 100 * change,
+                                                                   'REGRESSION' if regression else ''))
+            regressions += regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
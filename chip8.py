@@ -1,10 +1,80 @@
 import random
+import struct
+import sys
+from array import array
+from functools import partial
+from time import perf_counter_ns
+
+from fusion import FUSED_SIZE, fuse
+from instructions import INSTRUCTION_IDS, INSTRUCTION_NAMES, SparseDecodeTable, get_decode_table, get_instruction_name
+
+# Predefined fonts (0-F) for easy displaying of numbers. Shared by every Chip8State
+FONTSET = [[0xF0, 0x90, 0x90, 0x90, 0xF0],  # 0
+           [0x20, 0x60, 0x20, 0x20, 0x70],  # 1
+           [0xF0, 0x10, 0xF0, 0x80, 0xF0],  # 2
+           [0xF0, 0x10, 0xF0, 0x10, 0xF0],  # 3
+           [0x90, 0x90, 0xF0, 0x10, 0x10],  # 4
+           [0xF0, 0x80, 0xF0, 0x10, 0xF0],  # 5
+           [0xF0, 0x80, 0xF0, 0x90, 0xF0],  # 6
+           [0xF0, 0x10, 0x20, 0x40, 0x40],  # 7
+           [0xF0, 0x90, 0xF0, 0x90, 0xF0],  # 8
+           [0xF0, 0x90, 0xF0, 0x10, 0xF0],  # 9
+           [0xF0, 0x90, 0xF0, 0x90, 0x90],  # A
+           [0xE0, 0x90, 0xE0, 0x90, 0xE0],  # B
+           [0xF0, 0x80, 0x80, 0x80, 0xF0],  # C
+           [0xE0, 0x90, 0x90, 0x90, 0xE0],  # D
+           [0xF0, 0x80, 0xF0, 0x80, 0xF0],  # E
+           [0xF0, 0x80, 0xF0, 0x80, 0x80]]  # F
+FONTSET_BYTES = bytes(byte for sprite in FONTSET for byte in sprite)
+
+# 32 packed rows of 64 pixels, all off
+BLANK_DISPLAY = array('Q', bytes(32 * 8))
+ROW_MASK = 0xFFFFFFFFFFFFFFFF
+
+# Snapshot layout: the header (magic, version, pc, I, sp, delay timer, sound timer, cycle count), then memory, V0-VF,
+# stack, display and keypad copied as raw bytes. The multi byte values are little endian
+SNAPSHOT_MAGIC = b'C8SS'
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<4sBHHbBBQ')
+_SNAPSHOT_MEMORY = _SNAPSHOT_HEADER.size
+_SNAPSHOT_REGS = _SNAPSHOT_MEMORY + 4096
+_SNAPSHOT_STACK = _SNAPSHOT_REGS + 16
+_SNAPSHOT_DISPLAY = _SNAPSHOT_STACK + 16 * 2
+_SNAPSHOT_KEYPAD = _SNAPSHOT_DISPLAY + 32 * 8
+SNAPSHOT_SIZE = _SNAPSHOT_KEYPAD + 16
+# The stack and display arrays are copied in the machine byte order, which has to be swapped on big endian machines
+_SWAP_BYTES = sys.byteorder != 'little'
+
+# Instructions that only decide whether the next instruction is skipped, from the registers and the keypad
+_SKIP_IDS = {INSTRUCTION_IDS[name] for name in ('SE_Vx', 'SNE_Vx', 'SE_Vy_Vy', 'SNE_Vx_Vy', 'SKP_Vx', 'SKNP_Vx')}
+_LD_VX_DT = INSTRUCTION_IDS['LD_Vx_DT']
+
+
+class _IdleLoop(Exception):
+    # Raised by the JP handler of run when the jump closes a loop that cannot exit before the timers tick or the
+    # keypad changes, i.e. before the end of the current batch of instructions
+    def __init__(self, start, length):
+        self.start = start
+        self.length = length
+
+
+class _KeyWait(Exception):
+    # Raised by the LD_Vx_K handler of run when the machine starts waiting for a key: nothing else runs until the end
+    # of the current batch of instructions
+    pass
+
 
 class Chip8State:
+    # No per instance __dict__, as we run thousands of instances side by side
+    __slots__ = ('gen_regs', 'index_reg', 'pc_reg', 'sp_reg', 'delay_timer', 'sound_timer', 'stack', 'keypad',
+                 'width', 'height', 'display', 'display_generation', 'fontset_loc', 'fontset', 'opcode', 'memory',
+                 'decode_table', 'fusion', '_fused', 'cycle_count', 'key_wait', 'rng', 'trace', 'tracer', 'stats',
+                 'profiler', 'code_cache')
+
     def __init__(self):
         # ################## Registers ########################## #
         # 16 General purpose registers, each is 1 byte, denoted by V0 to VF
-        self.gen_regs = None  # = [0x00]*16
+        self.gen_regs = None  # = bytearray(16)
         self.index_reg = None  # 1 Index Register (2 bytes long)
         # 1 Program Counter Register, points to the currently executing address in RAM (2 bytes long)
         self.pc_reg = None
@@ -14,6 +84,26 @@ class Chip8State:
         # ##################### Timers ########################## #
         self.delay_timer = None  # 1 Delay register (1 bytes long)
         self.sound_timer = None  # 1 Sound Register (1 bytes long)
+        # Both timers count down at 60 Hz, see tick_timers
+
+        # Number of instructions executed since initialise
+        self.cycle_count = None
+        # Register waiting for a key press (LD_Vx_K), None when not waiting. While waiting, the pc stays on the LD_Vx_K
+        # instruction and run lets the cycles pass without executing anything, see waiting_for_key
+        self.key_wait = None
+        # Random number generator of RND, seeded by initialise so that runs can be reproduced
+        self.rng = None
+        # When True every executed instruction is printed
+        self.trace = False
+        # When set (to a tracing.TraceBuffer) every executed instruction is recorded into it
+        self.tracer = None
+        # When set (to a stats.InstructionStats) every executed instruction is counted in it
+        self.stats = None
+        # When set (to a profiler.GuestProfiler) every executed instruction is attributed to its guest address
+        self.profiler = None
+        # When set (to a translator.BlockTranslator) it is told whenever the code it translated may have changed, see
+        # _code_written and _code_replaced
+        self.code_cache = None
 
         # TODO: Replace Additional variables with the actual Chip8 Implementation
         # ############### Additional variables ################## #
@@ -24,9 +114,14 @@ class Chip8State:
         self.keypad = None  # 16 keys (0x0 to 0xF) each 1 bit so total 16*1 = 16bits = 2bytes
         # Screen size = 64x32 pixels (each pixel is either 0(black) or 1(white))
         # Total size (in bytes) required = 64*32 bits = 64*32/8 bytes = 256 bytes
+        # The display is stored as 32 rows, each packed in a 64 bit int. The most significant bit is the leftmost
+        # pixel (x = 0) and the least significant one the rightmost pixel (x = 63)
         self.width = None
         self.height = None
         self.display = None
+        # Bumped every time an instruction (CLS or DRW) modifies the display, so front ends can tell when they have
+        # to redraw
+        self.display_generation = None
         # Predefined fonts (0-F) for easy displaying of numbers
         self.fontset_loc = None
         self.fontset = None  # 16 different fonts, each 5 bytes long so total 16*5 = 80 bytes
@@ -35,6 +130,14 @@ class Chip8State:
 
         # ##################### Memory ########################## #
         self.memory = None  # 4096 bytes
+        # Decode table used to execute instructions, the full one of instructions.get_decode_table unless a program
+        # image installed a smaller one (see load_program_image)
+        self.decode_table = None
+        # When True, run executes common pairs of instructions with a single fused handler (see fusion.py), and the
+        # other instructions with their handler already bound to their operands. _fused caches (fused handler or None,
+        # bound handler) for every address, built as they are reached and dropped when the code under them changes
+        self.fusion = False
+        self._fused = None
 
         # Total Memory: 0-4095 (0x000 to 0xFFF) i.e 4096 bytes
         #   - 0-511 (0x000 to 0x1FF) i.e 512 bytes reserved for Chip8 Interpreter but since in our case python is the
@@ -45,49 +148,241 @@ class Chip8State:
         #       - 3744 - 3775 (0xEA0 to EBF) i.e 32 bytes for call stack
         #   - 3840-4095 (0xF00 to 0xFFF) i.e 256 bytes for display
 
-    def initialise(self):
-        self.gen_regs = [0]*16
+    def initialise(self, seed=None):
+        """Resets the machine. seed seeds the random number generator of RND (None seeds it from the os)"""
+        # Registers, memory and keypad are compact byte buffers. bytearray and array refuse values that don't fit in
+        # their item size, so every handler masks its results to 8 (registers) or 16 (stack) bits before storing them.
+        self.gen_regs = bytearray(16)
         self.index_reg = 0
         self.pc_reg = 512
         self.sp_reg = -1
 
-        self.stack = [0]*16
+        self.stack = array('H', bytes(32))
 
-        self.memory = [0] * 4096
+        self.memory = bytearray(4096)
+        self.decode_table = None
+        self._code_replaced()
 
-        self.keypad = [0]*16
+        self.keypad = bytearray(16)
 
         self.delay_timer = 0
         self.sound_timer = 0
 
+        self.cycle_count = 0
+        self.key_wait = None
+        self.rng = random.Random(seed)
+
         self.width, self.height = 64, 32  # in pixels
-        self.display = [[0]*self.height for _ in range(self.width)]
+        self.display = array('Q', BLANK_DISPLAY)
+        self.display_generation = 0
 
         self.fontset_loc = 0
-        self.fontset = [[0xF0, 0x90, 0x90, 0x90, 0xF0],  # 0
-                         [0x20, 0x60, 0x20, 0x20, 0x70],  # 1
-                         [0xF0, 0x10, 0xF0, 0x80, 0xF0],  # 2
-                         [0xF0, 0x10, 0xF0, 0x10, 0xF0],  # 3
-                         [0x90, 0x90, 0xF0, 0x10, 0x10],  # 4
-                         [0xF0, 0x80, 0xF0, 0x10, 0xF0],  # 5
-                         [0xF0, 0x80, 0xF0, 0x90, 0xF0],  # 6
-                         [0xF0, 0x10, 0x20, 0x40, 0x40],  # 7
-                         [0xF0, 0x90, 0xF0, 0x90, 0xF0],  # 8
-                         [0xF0, 0x90, 0xF0, 0x10, 0xF0],  # 9
-                         [0xF0, 0x90, 0xF0, 0x90, 0x90],  # A
-                         [0xE0, 0x90, 0xE0, 0x90, 0xE0],  # B
-                         [0xF0, 0x80, 0x80, 0x80, 0xF0],  # C
-                         [0xE0, 0x90, 0x90, 0x90, 0xE0],  # D
-                         [0xF0, 0x80, 0xF0, 0x80, 0xF0],  # E
-                         [0xF0, 0x80, 0xF0, 0x80, 0x80]]  # F
-        for sprite_count, sprite in enumerate(self.fontset):
-            block = self.fontset_loc + sprite_count * 5
-            for byte_count, byte in enumerate(sprite):
-                sub_block = block + byte_count
-                self.memory[sub_block] = byte
+        self.fontset = FONTSET
+        self.memory[self.fontset_loc: self.fontset_loc + len(FONTSET_BYTES)] = FONTSET_BYTES
 
     def load_rom(self, rom):
+        if self.pc_reg + len(rom) > len(self.memory):
+            raise ValueError('rom of {} bytes does not fit in memory'.format(len(rom)))
+        # A single slice assignment copies the rom bytes straight into memory
         self.memory[self.pc_reg: self.pc_reg + len(rom)] = rom
+        self._code_replaced()
+
+    def snapshot(self):
+        """Returns the whole machine state (memory, registers, stack, timers, display and keypad) as bytes
+
+        The random number generator and the instrumentation (trace, tracer, stats, profiler) are not part of the
+        state.
+        """
+        stack, display = self.stack, self.display
+        if _SWAP_BYTES:
+            stack, display = array('H', stack), array('Q', display)
+            stack.byteswap()
+            display.byteswap()
+        return b''.join((
+            _SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.pc_reg, self.index_reg, self.sp_reg,
+                                  self.delay_timer, self.sound_timer, self.cycle_count),
+            self.memory, self.gen_regs, stack, display, self.keypad))
+
+    def restore(self, snapshot):
+        """Restores a state returned by snapshot, copying it into the existing buffers"""
+        if len(snapshot) != SNAPSHOT_SIZE:
+            raise ValueError('snapshot of {} bytes, expected {}'.format(len(snapshot), SNAPSHOT_SIZE))
+        (magic, version, self.pc_reg, self.index_reg, self.sp_reg, self.delay_timer, self.sound_timer,
+         self.cycle_count) = _SNAPSHOT_HEADER.unpack_from(snapshot)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('not a version {} snapshot'.format(SNAPSHOT_VERSION))
+        view = memoryview(snapshot)
+        self.memory[:] = view[_SNAPSHOT_MEMORY: _SNAPSHOT_REGS]
+        self.gen_regs[:] = view[_SNAPSHOT_REGS: _SNAPSHOT_STACK]
+        memoryview(self.stack).cast('B')[:] = view[_SNAPSHOT_STACK: _SNAPSHOT_DISPLAY]
+        memoryview(self.display).cast('B')[:] = view[_SNAPSHOT_DISPLAY: _SNAPSHOT_KEYPAD]
+        self.keypad[:] = view[_SNAPSHOT_KEYPAD:]
+        if _SWAP_BYTES:
+            self.stack.byteswap()
+            self.display.byteswap()
+        # A machine that was waiting for a key is on its LD_Vx_K instruction, and waits again once it executes it
+        self.key_wait = None
+        # The memory may hold a different program
+        self._code_replaced()
+        # The display changed as far as front ends can tell
+        self.display_generation += 1
+
+    def load_program_image(self, image):
+        """Loads the rom of a program image (see analyzer.py) and installs its pre-decoded instructions
+
+        The opcodes found in the code of the rom are already decoded in the image, so the machine runs without building
+        the full decode table. Opcodes outside of them (code the analysis could not reach, or code written at run time)
+        are decoded on first use.
+        """
+        self.load_rom(image.rom)
+        self.decode_table = SparseDecodeTable(image.decoded)
+
+    def _get_decode_table(self):
+        if self.decode_table is None:
+            self.decode_table = get_decode_table()
+        return self.decode_table
+
+    def keypad_mask(self):
+        """Returns the keypad as a 16 bit mask, bit k is set if key k is pressed"""
+        mask = 0
+        for key, pressed in enumerate(self.keypad):
+            if pressed:
+                mask |= 1 << key
+        return mask
+
+    def set_keypad_mask(self, mask):
+        for key in range(16):
+            self.keypad[key] = (mask >> key) & 1
+        if self.key_wait is not None:
+            self.waiting_for_key()
+
+    def waiting_for_key(self):
+        """True if the machine waits for a key press (LD_Vx_K)
+
+        If it was waiting and a key is now pressed, the wait ends: the lowest pressed key is stored in the waiting
+        register and the pc moves past the LD_Vx_K instruction.
+        """
+        if self.key_wait is None:
+            return False
+        keypad = self.keypad
+        if not any(keypad):
+            return True
+        self.gen_regs[self.key_wait] = keypad.index(1)
+        self.key_wait = None
+        self.pc_reg += 2
+        return False
+
+    def get_pixel(self, x, y):
+        return (self.display[y] >> (63 - x)) & 1
+
+    def framebuffer_bytes(self):
+        """Returns the display as 256 bytes, 8 per row from top to bottom. The most significant bit is the left pixel"""
+        return b''.join(row.to_bytes(8, 'big') for row in self.display)
+
+    def tick_timers(self):
+        """Decrements the delay and sound timers. Has to be called 60 times per emulated second"""
+        if self.delay_timer > 0:
+            self.delay_timer -= 1
+        if self.sound_timer > 0:
+            self.sound_timer -= 1
+
+    def is_instrumented(self):
+        """True if executed instructions have to be observed (printed, traced or counted) one by one"""
+        return self.trace or self.tracer is not None or self.stats is not None or self.profiler is not None
+
+    def run(self, cycles):
+        """Executes the given number of instructions
+
+        While waiting for a key (see waiting_for_key), from the LD_Vx_K that starts the wait on, nothing is executed and
+        the cycles still count as run. The same goes for idle loops (a jump to itself, a skip polling the keypad or a
+        register and a jump back to it, or the same polling the delay timer with LD_Vx_DT): they cannot exit before the
+        end of the batch, when the timers tick and the keypad can change, so the rest of the batch is skipped and the
+        pc is set to where the loop would be.
+        """
+        if self.key_wait is not None and self.waiting_for_key():
+            self.cycle_count += cycles
+            return
+        if self.is_instrumented():
+            cpu_cycle = self.cpu_cycle
+            for _ in range(cycles):
+                cpu_cycle()
+            return
+        if self.fusion:
+            self._run_fused(cycles)
+            return
+
+        # Same as calling cpu_cycle repeatedly, with the attribute lookups hoisted out of the loop
+        memory = self.memory
+        decode_table = self._get_decode_table()
+        handlers = self._run_handlers
+        try:
+            for executed in range(cycles):
+                pc = self.pc_reg
+                opcode = (memory[pc] << 8) | memory[pc + 1]
+                entry = decode_table[opcode]
+                if entry is None:
+                    raise ValueError('opcode {} is not a valid instruction'.format(opcode))
+                self.opcode = opcode
+                inst_id, x, y, n, kk, nnn = entry
+                handlers[inst_id](self, x, y, n, kk, nnn)
+        except _IdleLoop as idle:
+            # The jump and the rest of the cycles go around the loop, one instruction each
+            self.pc_reg = idle.start + 2 * ((cycles - executed - 1) % idle.length)
+        except _KeyWait:
+            # The rest of the cycles pass waiting
+            pass
+        self.cycle_count += cycles
+
+    def _run_fused(self, cycles):
+        # Same as the loop of run, without the fetch and decode: a fused handler (see fusion.py) runs the pairs of
+        # instructions that have one when the budget has room for both, a bound handler runs any other instruction
+        memory = self.memory
+        if self._fused is None:
+            self._fused = [None] * len(memory)
+        fused = self._fused
+        executed = 0
+        try:
+            while executed < cycles:
+                pc = self.pc_reg
+                cached = fused[pc]
+                if cached is None:
+                    cached = fused[pc] = self._bind(pc)
+                pair, single = cached
+                if pair is not None and executed + 2 <= cycles:
+                    executed += pair()
+                    continue
+                single()
+                executed += 1
+        except _IdleLoop as idle:
+            self.pc_reg = idle.start + 2 * ((cycles - executed - 1) % idle.length)
+        except _KeyWait:
+            pass
+        self.cycle_count += cycles
+
+    def _bind(self, address):
+        # Returns (fused handler or None, handler bound to the operands) of the instruction at address, for _run_fused
+        opcode = (self.memory[address] << 8) | self.memory[address + 1]
+        entry = self._get_decode_table()[opcode]
+        if entry is None:
+            raise ValueError('opcode {} is not a valid instruction'.format(opcode))
+        inst_id, x, y, n, kk, nnn = entry
+        return fuse(self, address), partial(self._run_handlers[inst_id], self, x, y, n, kk, nnn)
+
+    def _code_written(self, start, end):
+        # Drops the handlers cached by _run_fused for the instructions and pairs that cover any byte in [start, end),
+        # and the code translated from these bytes
+        fused = self._fused
+        if fused is not None:
+            for address in range(max(start - FUSED_SIZE + 1, 0), min(end, len(fused))):
+                fused[address] = None
+        if self.code_cache is not None:
+            self.code_cache.invalidate(start, end)
+
+    def _code_replaced(self):
+        # Same as _code_written for the whole memory
+        self._fused = None
+        if self.code_cache is not None:
+            self.code_cache.invalidate_all()
 
     def cpu_cycle(self):
         """Fetches, decodes and executes the instruction at the memory address pointed by the pc register
@@ -95,386 +390,307 @@ class Chip8State:
         """
         # Fetch
         # All instructions are 2 bytes long. Read 1 byte. Read the next byte. Join them
-        self.opcode = (self.memory[self.pc_reg] << 8) | self.memory[self.pc_reg + 1]
-
-        # Decode
-        instruction_name = self.get_instruction_name(self.opcode)
-        print('{}: {}, {}'.format(self.pc_reg, hex(self.opcode), instruction_name))
+        pc = self.pc_reg
+        self.opcode = (self.memory[pc] << 8) | self.memory[pc + 1]
+
+        # Decode (a single lookup in the precomputed decode table)
+        entry = self._get_decode_table()[self.opcode]
+        tracer = self.tracer
+        if entry is None:
+            if tracer is not None:
+                # The instruction the run fails on is the last one of the trace
+                tracer.record(pc, self.opcode, bytes(self.gen_regs) if tracer.registers else None, self)
+            raise ValueError('opcode {} is not a valid instruction'.format(self.opcode))
+        inst_id, x, y, n, kk, nnn = entry
+        if self.trace:
+            print('{}: {}, {}'.format(self.pc_reg, hex(self.opcode), INSTRUCTION_NAMES[inst_id]))
 
         # Execute instruction and move pc
-        self.execute_instruction(instruction_name)
+        stats = self.stats
+        profiler = self.profiler
+        if tracer is None and stats is None and profiler is None:
+            self._handlers[inst_id](self, x, y, n, kk, nnn)
+            self.cycle_count += 1
+            return
+
+        opcode = self.opcode
+        registers_before = bytes(self.gen_regs) if tracer is not None and tracer.registers else None
+        try:
+            if stats is not None and stats.count(inst_id):
+                start = perf_counter_ns()
+                self._handlers[inst_id](self, x, y, n, kk, nnn)
+                stats.add_sample(inst_id, perf_counter_ns() - start)
+            else:
+                self._handlers[inst_id](self, x, y, n, kk, nnn)
+        finally:
+            # Also when the handler fails (stack overflow, address out of memory), so that the trace ends with the
+            # instruction that failed
+            if tracer is not None:
+                tracer.record(pc, opcode, registers_before, self)
+        if profiler is not None:
+            profiler.record(pc, inst_id, nnn)
+        self.cycle_count += 1
 
     @staticmethod
     def get_instruction_name(opcode):
-        # Checking which one of 35 known instructions does the opcode belong to
-        if opcode == 0x00E0:
-            inst_name = 'CLS'
-        elif opcode == 0x00EE:
-            inst_name = 'RET'
-        elif opcode & 0xF000 == 0x0000:
-            inst_name = 'SYS'
-        elif opcode & 0xF000 == 0x1000:
-            inst_name = 'JP'
-        elif opcode & 0xF000 == 0x2000:
-            inst_name = 'CALL'
-        elif opcode & 0xF000 == 0x3000:
-            inst_name = 'SE_Vx'
-        elif opcode & 0xF000 == 0x4000:
-            inst_name = 'SNE_Vx'
-        elif opcode & 0xF00F == 0x5000:
-            inst_name = 'SE_Vy_Vy'
-        elif opcode & 0xF000 == 0x6000:
-            inst_name = 'LD_Vx'
-        elif opcode & 0xF000 == 0x7000:
-            inst_name = 'ADD_Vx'
-        elif opcode & 0xF00F == 0x8000:
-            inst_name = 'LD_Vx_Vy'
-        elif opcode & 0xF00F == 0x8001:
-            inst_name = 'OR_Vx_Vy'
-        elif opcode & 0xF00F == 0x8002:
-            inst_name = 'AND_Vx_Vy'
-        elif opcode & 0xF00F == 0x8003:
-            inst_name = 'XOR_Vx_Vy'
-        elif opcode & 0xF00F == 0x8004:
-            inst_name = 'ADD_Vx_Vy'
-        elif opcode & 0xF00F == 0x8005:
-            inst_name = 'SUB_Vx_Vy'
-        elif opcode & 0xF00F == 0x8006:
-            inst_name = 'SHR_Vx_Vy'
-        elif opcode & 0xF00F == 0x8007:
-            inst_name = 'SUBN_Vx_Vy'
-        elif opcode & 0xF00F == 0x800E:
-            inst_name = 'SHL_Vx_Vy'
-        elif opcode & 0xF00F == 0x9000:
-            inst_name = 'SNE_Vx_Vy'
-        elif opcode & 0xF000 == 0xA000:
-            inst_name = 'LD_I'
-        elif opcode & 0xF000 == 0xB000:
-            inst_name = 'JP_V0'
-        elif opcode & 0xF000 == 0xC000:
-            inst_name = 'RND_Vx'
-        elif opcode & 0xF000 == 0xD000:
-            inst_name = 'DRW_Vx_Vy'
-        elif opcode & 0xF0FF == 0xE09E:
-            inst_name = 'SKP_Vx'
-        elif opcode & 0xF0FF == 0xE0A1:
-            inst_name = 'SKNP_Vx'
-        elif opcode & 0xF0FF == 0xF007:
-            inst_name = 'LD_Vx_DT'
-        elif opcode & 0xF0FF == 0xF00A:
-            inst_name = 'LD_Vx_K'
-        elif opcode & 0xF0FF == 0xF015:
-            inst_name = 'LD_DT_Vx'
-        elif opcode & 0xF0FF == 0xF018:
-            inst_name = 'LD_ST_Vx'
-        elif opcode & 0xF0FF == 0xF01E:
-            inst_name = 'ADD_I_Vx'
-        elif opcode & 0xF0FF == 0xF029:
-            inst_name = 'LD_F_Vx'
-        elif opcode & 0xF0FF == 0xF033:
-            inst_name = 'LD_B_Vx'
-        elif opcode & 0xF0FF == 0xF055:
-            inst_name = 'LD_I_Vx'
-        elif opcode & 0xF0FF == 0xF065:
-            inst_name = 'LD_Vx_I'
-        else:
-            raise ValueError('opcode {} is not a valid instruction'.format(opcode))
-
-        return inst_name
+        return get_instruction_name(opcode)
 
     def execute_instruction(self, instruction_name):
-        # Helpers
-        # default bitwise right shift is arithmetic but we want logical but since we know we only deal with
-        # unsigned numbers there is no problem (as for unsigned numbers arithmetic and logical bitwise right
-        # shifts are the same)
-        def get_x():
-            # opcode is of form 0x6xkk. x is the 2nd from right (in hex representation)
-            return (self.opcode & 0x0F00) >> 8
-
-        def get_y():
-            # opcode is of form 0x5xy0. y is the 3nd from right (in hex representation)
-            return (self.opcode & 0x00F0) >> 4
-
-        # Instruction definitions
-        def _cls():
-            for i in range(len(self.display)):
-                self.display[i] = 0
-            self.pc_reg += 2
-            return
-
-        def _ret():
-            # Not incrementing pc by 2
-            self.pc_reg = self.stack[self.sp_reg]
-            self.sp_reg -= 1
-            return
-
-        def _sys():
-            # TODO: Implement this
-            return
-
-        def _jp():
-            # Not incrementing pc by 2
-            self.pc_reg = self.opcode & 0x0FFF
-            return
-
-        def _call():
-            # Not incrementing pc by 2
-            self.sp_reg += 1
-            self.stack[self.sp_reg] = self.pc_reg + 2
-            self.pc_reg = self.opcode & 0x0FFF
-            return
-
-        def _se_vx():
-            if self.gen_regs[get_x()] == self.opcode & 0x00FF:
-                self.pc_reg += 2
-            self.pc_reg += 2
-            return
-
-        def _sne_vx():
-            if self.gen_regs[get_x()] != self.opcode & 0x00FF:
-                self.pc_reg += 2
-            self.pc_reg += 2
-            return
-
-        def _se_vx_vy():
-            if self.gen_regs[get_x()] == self.gen_regs[get_y()]:
-                self.pc_reg += 2
-            self.pc_reg += 2
-            return
-
-        def _ld_vx():
-            self.gen_regs[get_x()] = self.opcode & 0x00FF
-            self.pc_reg += 2
-            return
-
-        def _add_vx():
-            x_pos = get_x()
-            a = self.gen_regs[x_pos] + self.opcode & 0x00FF
-            a = a & 0xFF  # Making sure it remains 1 bytes long (as every gen_reg is 1 byte long)
-            self.gen_regs[x_pos] = a
-            self.pc_reg += 2
-            return
-
-        def _ld_vx_vy():
-            self.gen_regs[get_x()] = self.gen_regs[get_y()]
-            self.pc_reg += 2
-            return
+        """Executes the instruction with the given name using the operands of the currently read opcode"""
+        opcode = self.opcode
+        self._handlers[INSTRUCTION_IDS[instruction_name]](
+            self, (opcode & 0x0F00) >> 8, (opcode & 0x00F0) >> 4, opcode & 0x000F, opcode & 0x00FF, opcode & 0x0FFF)
+
+    # Instruction definitions
+    # Every handler receives the operands pre-extracted by the decode table. For an opcode 0x?xyn (= 0x?xkk = 0x?nnn)
+    # x and y are register numbers, n is the lowest nibble, kk the lowest byte and nnn the lowest 12 bits.
+    def _cls(self, x, y, n, kk, nnn):
+        self.display[:] = BLANK_DISPLAY
+        self.display_generation += 1
+        self.pc_reg += 2
+
+    def _ret(self, x, y, n, kk, nnn):
+        # Not incrementing pc by 2
+        self.pc_reg = self.stack[self.sp_reg]
+        self.sp_reg -= 1
+
+    def _sys(self, x, y, n, kk, nnn):
+        # TODO: Implement this
+        return
 
-        def _or_vx_vy():
-            x_pos = get_x()
-            y_pos = get_y()
-            self.gen_regs[x_pos] = self.gen_regs[x_pos] | self.gen_regs[y_pos]
+    def _jp(self, x, y, n, kk, nnn):
+        # Not incrementing pc by 2
+        self.pc_reg = nnn
+
+    def _jp_idle(self, x, y, n, kk, nnn):
+        # JP as run executes it. A jump back to itself, or to the 1 or 2 instructions right before it, may close an
+        # idle loop
+        distance = self.pc_reg - nnn
+        if distance in (0, 2, 4) and self._is_idle_loop(nnn, self.pc_reg):
+            raise _IdleLoop(nnn, distance // 2 + 1)
+        self.pc_reg = nnn
+
+    def _is_idle_loop(self, start, jump, entering=False):
+        # True if the loop from start to the jump at jump (its last instruction) has no effect and cannot exit until
+        # the timers or the keypad change. entering is True when the pc is at start and the loop has not run yet
+        if start == jump:
+            return True
+        memory = self.memory
+        decode_table = self._get_decode_table()
+        skip = decode_table[(memory[jump - 2] << 8) | memory[jump - 1]]
+        if skip is None or skip[0] not in _SKIP_IDS:
+            return False
+        if jump - start == 4:
+            # LD Vx, DT then a skip. The loop is only idle if Vx holds the delay timer, which it does once the LD has
+            # run. When entering, run it now (it runs first anyway)
+            load = decode_table[(memory[start] << 8) | memory[start + 1]]
+            if load is None or load[0] != _LD_VX_DT:
+                return False
+            if entering:
+                self.gen_regs[load[1]] = self.delay_timer
+            elif self.gen_regs[load[1]] != self.delay_timer:
+                return False
+        # Skip handlers only move the pc: run the skip instruction and see whether it leaves the loop
+        pc = self.pc_reg
+        self.pc_reg = jump - 2
+        self._handlers[skip[0]](self, *skip[1:])
+        stays = self.pc_reg == jump
+        self.pc_reg = pc
+        return stays
+
+    def _call(self, x, y, n, kk, nnn):
+        # Not incrementing pc by 2
+        self.sp_reg += 1
+        self.stack[self.sp_reg] = self.pc_reg + 2
+        self.pc_reg = nnn
+
+    def _se_vx(self, x, y, n, kk, nnn):
+        if self.gen_regs[x] == kk:
             self.pc_reg += 2
-            return
+        self.pc_reg += 2
 
-        def _and_vx_vy():
-            x_pos = get_x()
-            y_pos = get_y()
-            self.gen_regs[x_pos] = self.gen_regs[x_pos] & self.gen_regs[y_pos]
+    def _sne_vx(self, x, y, n, kk, nnn):
+        if self.gen_regs[x] != kk:
             self.pc_reg += 2
-            return
+        self.pc_reg += 2
 
-        def _xor_vx_vy():
-            x_pos = get_x()
-            y_pos = get_y()
-            self.gen_regs[x_pos] = self.gen_regs[x_pos] ^ self.gen_regs[y_pos]
+    def _se_vx_vy(self, x, y, n, kk, nnn):
+        if self.gen_regs[x] == self.gen_regs[y]:
             self.pc_reg += 2
-            return
-
-        def _add_vx_vy():
-            x_pos = get_x()
-            y_pos = get_y()
-            a = self.gen_regs[x_pos] + self.gen_regs[y_pos]
-            add = a & 0xFF  # Making sure it remains 1 bytes long (as every gen_reg is 1 byte long)
-            carry = 0 if a == add else 1
-            self.gen_regs[x_pos] = add
-            self.gen_regs[15] = carry
-            self.pc_reg += 2
-            return
+        self.pc_reg += 2
+
+    def _ld_vx(self, x, y, n, kk, nnn):
+        self.gen_regs[x] = kk
+        self.pc_reg += 2
+
+    def _add_vx(self, x, y, n, kk, nnn):
+        # Making sure it remains 1 bytes long (as every gen_reg is 1 byte long)
+        self.gen_regs[x] = (self.gen_regs[x] + kk) & 0xFF
+        self.pc_reg += 2
+
+    def _ld_vx_vy(self, x, y, n, kk, nnn):
+        self.gen_regs[x] = self.gen_regs[y]
+        self.pc_reg += 2
+
+    def _or_vx_vy(self, x, y, n, kk, nnn):
+        self.gen_regs[x] = self.gen_regs[x] | self.gen_regs[y]
+        self.pc_reg += 2
+
+    def _and_vx_vy(self, x, y, n, kk, nnn):
+        self.gen_regs[x] = self.gen_regs[x] & self.gen_regs[y]
+        self.pc_reg += 2
+
+    def _xor_vx_vy(self, x, y, n, kk, nnn):
+        self.gen_regs[x] = self.gen_regs[x] ^ self.gen_regs[y]
+        self.pc_reg += 2
+
+    def _add_vx_vy(self, x, y, n, kk, nnn):
+        a = self.gen_regs[x] + self.gen_regs[y]
+        add = a & 0xFF  # Making sure it remains 1 bytes long (as every gen_reg is 1 byte long)
+        carry = 0 if a == add else 1
+        self.gen_regs[x] = add
+        self.gen_regs[15] = carry
+        self.pc_reg += 2
+
+    def _sub_vx_vy(self, x, y, n, kk, nnn):
+        if self.gen_regs[x] > self.gen_regs[y]:
+            self.gen_regs[15] = 1
+        else:
+            self.gen_regs[15] = 0
+        self.gen_regs[x] = (self.gen_regs[x] - self.gen_regs[y]) & 0xFF
+        self.pc_reg += 2
+
+    def _shr_vx_vy(self, x, y, n, kk, nnn):
+        self.gen_regs[15] = self.gen_regs[x] & 0b1
+        self.gen_regs[x] = self.gen_regs[x] >> 1
+        self.pc_reg += 2
+
+    def _subn_vx_vy(self, x, y, n, kk, nnn):
+        if self.gen_regs[y] > self.gen_regs[x]:
+            self.gen_regs[15] = 1
+        else:
+            self.gen_regs[15] = 0
+        self.gen_regs[x] = (self.gen_regs[y] - self.gen_regs[x]) & 0xFF
+        self.pc_reg += 2
 
-        def _sub_vx_vy():
-            x_pos = get_x()
-            y_pos = get_y()
-            if self.gen_regs[x_pos] > self.gen_regs[y_pos]:
-                self.gen_regs[15] = 1
-            else:
-                self.gen_regs[15] = 0
-            self.gen_regs[x_pos] -= self.gen_regs[y_pos]
-            self.pc_reg += 2
-            return
+    def _shl_vx_vy(self, x, y, n, kk, nnn):
+        self.gen_regs[15] = self.gen_regs[x] >> 7  # Most significant bit is shifted out
+        self.gen_regs[x] = (self.gen_regs[x] << 1) & 0xFF
+        self.pc_reg += 2
 
-        def _shr_vx_vy():
-            x_pos = get_x()
-            self.gen_regs[15] = self.gen_regs[x_pos] & 0b1
-            self.gen_regs[x_pos] = self.gen_regs[x_pos] >> 1
+    def _sne_vx_vy(self, x, y, n, kk, nnn):
+        if self.gen_regs[x] != self.gen_regs[y]:
             self.pc_reg += 2
-            return
-
-        def _subn_vx_vy():
-            x_pos = get_x()
-            y_pos = get_y()
-            if self.gen_regs[y_pos] > self.gen_regs[x_pos]:
-                self.gen_regs[15] = 1
+        self.pc_reg += 2
+
+    def _ld_i(self, x, y, n, kk, nnn):
+        self.index_reg = nnn
+        self.pc_reg += 2
+
+    def _jp_v0(self, x, y, n, kk, nnn):
+        # Not incrementing pc by 2
+        self.pc_reg = nnn + self.gen_regs[0]
+
+    def _rnd_vx(self, x, y, n, kk, nnn):
+        self.gen_regs[x] = self.rng.getrandbits(8) & kk
+        self.pc_reg += 2
+
+    def _drw_vx_vy(self, x, y, n, kk, nnn):
+        # Draws the n bytes long sprite stored at I, at (Vx, Vy). Each sprite byte is a row of 8 pixels that is XORed
+        # onto the display, wrapping around the edges. VF is set to 1 if any pixel that was on got turned off.
+        display = self.display
+        height = self.height
+        x_pos = self.gen_regs[x] % self.width
+        y_pos = self.gen_regs[y] % self.height
+        # Left shift that moves the sprite byte from the lowest 8 bits to columns x_pos to x_pos + 7 of a row
+        shift = 56 - x_pos
+        collision = 0
+        for row_count, sprite in enumerate(self.memory[self.index_reg: self.index_reg + n]):
+            if shift >= 0:
+                bits = sprite << shift
             else:
-                self.gen_regs[15] = 0
-            self.gen_regs[x_pos] = self.gen_regs[y_pos] - self.gen_regs[x_pos]
-            self.pc_reg += 2
-            return
-
-        def _shl_vx_vy():
-            x_pos = get_x()
-            self.gen_regs[15] = self.gen_regs[x_pos] & 0b1
-            self.gen_regs[x_pos] = self.gen_regs[x_pos] << 1
-            self.pc_reg += 2
-            return
-
-        def _sne_vx_vy():
-            if self.gen_regs[get_x()] != self.gen_regs[get_y()]:
-                self.pc_reg += 2
-            self.pc_reg += 2
-            return
-
-        def _ld_i():
-            self.index_reg = self.opcode & 0x0FFF
-            self.pc_reg += 2
-            return
-
-        def _jp_v0():
-            # Not incrementing pc by 2
-            self.pc_reg = self.opcode & 0x0FFF + self.gen_regs[0]
-            return
-
-        def _rnd_vx():
-            rand = random.randint(0, 256)
-            self.gen_regs[get_x()] = rand & (self.opcode & 0x00FF)
-            self.pc_reg += 2
-            return
-
-        def _drw_vx_vy():
-            # TODO: Understand This
-            x_reg_pos = get_x()
-            y_reg_pos = get_y()
-            nibble = self.opcode & 0x000F
-            sprites = [each for each in self.memory[self.index_reg: self.index_reg + nibble]]
-            for sprite_count, sprite in enumerate(sprites):
-                for bit_count in range(8):
-                    sprite_bit = (sprite >> bit_count) & 1
-                    x = (self.gen_regs[x_reg_pos] + (7-bit_count)) % self.width
-                    y = (self.gen_regs[y_reg_pos] + sprite_count) % self.height
-                    if sprite_bit ^ self.display[x][y] == 0:
-                        self.gen_regs[15] = 1
-                    else:
-                        self.gen_regs[15] = 0
-                    self.display[x][y] ^= sprite_bit
-            self.pc_reg += 2
-            return
-
-        def _skp_vx():
-            if self.keypad[self.gen_regs[get_x()]] == 1:
-                self.pc_reg += 2
-            self.pc_reg += 2
-            return
-
-        def _sknp_vx():
-            if self.keypad[self.gen_regs[get_x()]] != 1:
-                self.pc_reg += 2
-            self.pc_reg += 2
-            return
-
-        def _ld_vx_dt():
-            self.gen_regs[get_x()] = self.delay_timer
-            self.pc_reg += 2
-            return
-
-        def _ld_vx_k():
-            loop = True
-            while loop is True:
-                for each in self.keypad:
-                    if each == 1:
-                        loop = False
-            self.pc_reg += 2
-            return
-
-        def _ld_dt_vx():
-            self.delay_timer = self.gen_regs[get_x()]
+                # The sprite crosses the right edge, the pixels that go past it wrap around to the left edge
+                bits = (sprite >> -shift) | ((sprite << (64 + shift)) & ROW_MASK)
+            row = (y_pos + row_count) % height
+            collision |= display[row] & bits
+            display[row] ^= bits
+        self.gen_regs[15] = 1 if collision else 0
+        self.display_generation += 1
+        self.pc_reg += 2
+
+    def _skp_vx(self, x, y, n, kk, nnn):
+        if self.keypad[self.gen_regs[x]] == 1:
             self.pc_reg += 2
-            return
+        self.pc_reg += 2
 
-        def _ld_st_vx():
-            self.sound_timer = self.gen_regs[get_x()]
+    def _sknp_vx(self, x, y, n, kk, nnn):
+        if self.keypad[self.gen_regs[x]] != 1:
             self.pc_reg += 2
-            return
-
-        def _add_i_vx():
-            a = self.index_reg + self.gen_regs[get_x()]
-            self.index_reg = a & 0xFFFF  # Making sure it remains 2 bytes long as index_reg is 2 bytes long
-            self.pc_reg += 2
-            return
-
-        def _ld_f_vx():
-            self.index_reg = self.fontset_loc + (self.gen_regs[get_x()])*5
-            self.pc_reg += 2
-            return
-
-        def _ld_b_vx():
-            vx = self.gen_regs[get_x()]
-            self.memory[self.index_reg] = (vx // 100) % 10
-            self.memory[self.index_reg + 1] = (vx // 10) % 10
-            self.memory[self.index_reg + 2] = vx % 10
-            self.pc_reg += 2
-            return
-
-        def _ld_i_vx():
-            x_pos = get_x()
-            for i in range(x_pos + 1):
-                self.memory[self.index_reg + i] = self.gen_regs[i]
-            self.pc_reg += 2
-            return
-
-        def _ld_vx_i():
-            x_pos = get_x()
-            for i in range(x_pos + 1):
-                self.gen_regs[i] = self.memory[self.index_reg + i]
-            self.pc_reg += 2
-            return
-
-        instruction_map = {
-            'CLS': _cls,
-            'RET': _ret,
-            'SYS': _sys,
-            'JP': _jp,
-            'CALL': _call,
-            'SE_Vx': _se_vx,
-            'SNE_Vx': _sne_vx,
-            'SE_Vy_Vy': _se_vx_vy,
-            'LD_Vx': _ld_vx,
-            'ADD_Vx': _add_vx,
-            'LD_Vx_Vy': _ld_vx_vy,
-            'OR_Vx_Vy': _or_vx_vy,
-            'AND_Vx_Vy': _and_vx_vy,
-            'XOR_Vx_Vy': _xor_vx_vy,
-            'ADD_Vx_Vy': _add_vx_vy,
-            'SUB_Vx_Vy': _sub_vx_vy,
-            'SHR_Vx_Vy': _shr_vx_vy,
-            'SUBN_Vx_Vy': _subn_vx_vy,
-            'SHL_Vx_Vy': _shl_vx_vy,
-            'SNE_Vx_Vy': _sne_vx_vy,
-            'LD_I': _ld_i,
-            'JP_V0': _jp_v0,
-            'RND_Vx': _rnd_vx,
-            'DRW_Vx_Vy': _drw_vx_vy,
-            'SKP_Vx': _skp_vx,
-            'SKNP_Vx': _sknp_vx,
-            'LD_Vx_DT': _ld_vx_dt,
-            'LD_Vx_K': _ld_vx_k,
-            'LD_DT_Vx': _ld_dt_vx,
-            'LD_ST_Vx': _ld_st_vx,
-            'ADD_I_Vx': _add_i_vx,
-            'LD_F_Vx': _ld_f_vx,
-            'LD_B_Vx': _ld_b_vx,
-            'LD_I_Vx': _ld_i_vx,
-            'LD_Vx_I': _ld_vx_i,
-        }
-
-        instruction_map[instruction_name]()
-        return
+        self.pc_reg += 2
+
+    def _ld_vx_dt(self, x, y, n, kk, nnn):
+        self.gen_regs[x] = self.delay_timer
+        self.pc_reg += 2
+
+    def _ld_vx_k(self, x, y, n, kk, nnn):
+        # Without a pressed key the pc stays here, and the machine idles from the next run until a key is pressed.
+        # Executing this again in the meantime only checks the keypad again
+        self.key_wait = x
+        self.waiting_for_key()
+
+    def _ld_vx_k_wait(self, x, y, n, kk, nnn):
+        # LD_Vx_K as run executes it
+        self.key_wait = x
+        if self.waiting_for_key():
+            raise _KeyWait()
+
+    def _ld_dt_vx(self, x, y, n, kk, nnn):
+        self.delay_timer = self.gen_regs[x]
+        self.pc_reg += 2
+
+    def _ld_st_vx(self, x, y, n, kk, nnn):
+        self.sound_timer = self.gen_regs[x]
+        self.pc_reg += 2
+
+    def _add_i_vx(self, x, y, n, kk, nnn):
+        a = self.index_reg + self.gen_regs[x]
+        self.index_reg = a & 0xFFFF  # Making sure it remains 2 bytes long as index_reg is 2 bytes long
+        self.pc_reg += 2
+
+    def _ld_f_vx(self, x, y, n, kk, nnn):
+        self.index_reg = self.fontset_loc + (self.gen_regs[x])*5
+        self.pc_reg += 2
+
+    def _ld_b_vx(self, x, y, n, kk, nnn):
+        vx = self.gen_regs[x]
+        self.memory[self.index_reg] = (vx // 100) % 10
+        self.memory[self.index_reg + 1] = (vx // 10) % 10
+        self.memory[self.index_reg + 2] = vx % 10
+        self._code_written(self.index_reg, self.index_reg + 3)
+        self.pc_reg += 2
+
+    def _ld_i_vx(self, x, y, n, kk, nnn):
+        for i in range(x + 1):
+            self.memory[self.index_reg + i] = self.gen_regs[i]
+        self._code_written(self.index_reg, self.index_reg + x + 1)
+        self.pc_reg += 2
+
+    def _ld_vx_i(self, x, y, n, kk, nnn):
+        for i in range(x + 1):
+            self.gen_regs[i] = self.memory[self.index_reg + i]
+        self.pc_reg += 2
+
+    # Instruction handlers indexed by the instruction id from the decode table (same order as INSTRUCTION_NAMES), called
+    # as handler(chip8, x, y, n, kk, nnn). Plain functions shared by every instance: tables of bound methods would cost
+    # every instance a few KB and tie it into a reference cycle that only the garbage collector frees
+    _handlers = (
+        _cls, _ret, _sys, _jp, _call, _se_vx, _sne_vx, _se_vx_vy, _ld_vx, _add_vx, _ld_vx_vy, _or_vx_vy, _and_vx_vy,
+        _xor_vx_vy, _add_vx_vy, _sub_vx_vy, _shr_vx_vy, _subn_vx_vy, _shl_vx_vy, _sne_vx_vy, _ld_i, _jp_v0, _rnd_vx,
+        _drw_vx_vy, _skp_vx, _sknp_vx, _ld_vx_dt, _ld_vx_k, _ld_dt_vx, _ld_st_vx, _add_i_vx, _ld_f_vx, _ld_b_vx,
+        _ld_i_vx, _ld_vx_i,
+    )
+    # The handlers used by run, where JP also looks for idle loops and LD_Vx_K ends the batch when it starts waiting
+    _run_handlers = list(_handlers)
+    _run_handlers[INSTRUCTION_IDS['JP']] = _jp_idle
+    _run_handlers[INSTRUCTION_IDS['LD_Vx_K']] = _ld_vx_k_wait
+    _run_handlers = tuple(_run_handlers)
@@ -0,0 +1,93 @@
+"""Runs large sweeps of headless jobs on a pool of worker processes
+
+Usage: python fleet.py JOBS.json [--workers N] [--chunk-size N] [--timeout SECONDS]
+
+JOBS.json is a list of jobs, each an object with the keys rom (path or name of a rom in ROMS/), cycles (budget),
+and optionally inputs (list of [cycle, keypad_mask] pairs, see headless.run_with_inputs), seed and ips. One JSON line
+is printed per job, in the order the jobs finish.
+"""
+import argparse
+import json
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from chip8 import Chip8State
+from headless import framebuffer_hash, run_with_inputs
+from instructions import get_decode_table
+from roms import read_rom
+from scheduler import DEFAULT_INSTRUCTIONS_PER_SECOND, Scheduler
+
+Job = namedtuple('Job', ['rom', 'cycles', 'inputs', 'seed', 'instructions_per_second'])
+Job.__new__.__defaults__ = ((), None, DEFAULT_INSTRUCTIONS_PER_SECOND)
+
+JobResult = namedtuple('JobResult', ['job_index', 'rom', 'seed', 'cycles', 'frames', 'seconds', 'framebuffer_hash',
+                                     'timed_out', 'error'])
+
+
+def run_job(job_index, job, timeout=None):
+    """Runs a single job in the current process and returns its JobResult"""
+    try:
+        rom_bytes = read_rom(job.rom)
+        # Build the decode table before starting the clock, so the first job of a worker is not slower
+        get_decode_table()
+
+        chip8 = Chip8State()
+        chip8.initialise(job.seed)
+        chip8.load_rom(rom_bytes)
+        scheduler = Scheduler(chip8, job.instructions_per_second)
+
+        time_start = time.perf_counter()
+        deadline = None if timeout is None else time_start + timeout
+        finished = run_with_inputs(chip8, scheduler, job.inputs, job.cycles, deadline)
+        seconds = time.perf_counter() - time_start
+    except Exception as e:
+        return JobResult(job_index, job.rom, job.seed, 0, 0, 0.0, None, False, '{}: {}'.format(type(e).__name__, e))
+
+    return JobResult(job_index, job.rom, job.seed, chip8.cycle_count, scheduler.frame_count, seconds,
+                     framebuffer_hash(chip8), not finished, None)
+
+
+def _run_chunk(chunk, timeout):
+    return [run_job(job_index, job, timeout) for job_index, job in chunk]
+
+
+def run_fleet(jobs, workers=None, chunk_size=1, timeout=None):
+    """Runs the jobs on a pool of worker processes and yields their JobResults as they finish
+
+    Jobs are sent to the workers in chunks of chunk_size, larger chunks lower the overhead for short jobs. timeout is
+    the maximum number of seconds a single job may run, a job that hits it is stopped and its result has timed_out
+    set. workers defaults to the number of cpus.
+    """
+    indexed_jobs = list(enumerate(jobs))
+    chunks = [indexed_jobs[i: i + chunk_size] for i in range(0, len(indexed_jobs), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_chunk, chunk, timeout) for chunk in chunks]
+        for future in as_completed(futures):
+            for result in future.result():
+                yield result
+
+
+def load_jobs(path):
+    with open(path) as f:
+        specs = json.load(f)
+    return [Job(spec['rom'], spec['cycles'], [tuple(event) for event in spec.get('inputs', ())], spec.get('seed'),
+                spec.get('ips', DEFAULT_INSTRUCTIONS_PER_SECOND)) for spec in specs]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a sweep of headless CHIP-8 jobs on a pool of processes')
+    parser.add_argument('jobs', help='JSON file with the list of jobs')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: number of cpus)')
+    parser.add_argument('--chunk-size', type=int, default=1, help='jobs sent to a worker at once (default: 1)')
+    parser.add_argument('--timeout', type=float, help='maximum seconds per job')
+    args = parser.parse_args(argv)
+
+    for result in run_fleet(load_jobs(args.jobs), args.workers, args.chunk_size, args.timeout):
+        print(json.dumps(result._asdict()))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Superinstructions: pairs of adjacent instructions executed by a single fused handler
+
+Used by Chip8State.run when its fusion is turned on (the other instructions then run with their handler bound to their
+operands, see Chip8State._run_fused). Every fused handler replaces the fetch, decode and dispatch of two instructions
+by one call, with the operands of both already bound when the pair is decoded. The pairs are:
+
+- LD I, nnn then DRW (drawing a sprite)
+- LD F, Vx then DRW (drawing a digit)
+- SE/SNE Vx, kk then JP (conditional jump)
+- ADD Vx, kk then SE/SNE Vx, kk (counting loop)
+
+A fused handler returns the number of instructions it executed (a skip over the JP executes 1), and behaves exactly as
+the two instructions would one after the other.
+"""
+from instructions import INSTRUCTION_IDS
+
+_LD_I = INSTRUCTION_IDS['LD_I']
+_LD_F_VX = INSTRUCTION_IDS['LD_F_Vx']
+_DRW_VX_VY = INSTRUCTION_IDS['DRW_Vx_Vy']
+_SE_VX = INSTRUCTION_IDS['SE_Vx']
+_SNE_VX = INSTRUCTION_IDS['SNE_Vx']
+_JP = INSTRUCTION_IDS['JP']
+_ADD_VX = INSTRUCTION_IDS['ADD_Vx']
+
+# Number of bytes covered by a fused pair
+FUSED_SIZE = 4
+
+
+def fuse(chip8, address):
+    """Returns the fused handler of the instructions at address, or None if they don't form a fusable pair"""
+    memory = chip8.memory
+    if address + 3 >= len(memory):
+        return None
+    decode_table = chip8._get_decode_table()
+    first = decode_table[(memory[address] << 8) | memory[address + 1]]
+    second = decode_table[(memory[address + 2] << 8) | memory[address + 3]]
+    if first is None or second is None:
+        return None
+    first_id, x, _, _, kk, nnn = first
+    second_id = second[0]
+
+    if second_id == _DRW_VX_VY and first_id in (_LD_I, _LD_F_VX):
+        drw = chip8._drw_vx_vy
+        draw_x, draw_y, draw_n = second[1], second[2], second[3]
+        if first_id == _LD_I:
+            def ld_i_drw():
+                chip8.index_reg = nnn
+                chip8.pc_reg += 2
+                drw(draw_x, draw_y, draw_n, 0, 0)
+                return 2
+            return ld_i_drw
+
+        regs = chip8.gen_regs
+
+        def ld_f_drw():
+            chip8.index_reg = chip8.fontset_loc + regs[x] * 5
+            chip8.pc_reg += 2
+            drw(draw_x, draw_y, draw_n, 0, 0)
+            return 2
+        return ld_f_drw
+
+    if first_id in (_SE_VX, _SNE_VX) and second_id == _JP:
+        target = second[5]
+        if address - 2 <= target <= address + 2:
+            # A jump back over at most 2 instructions may close an idle loop, which run has to see (see
+            # Chip8State.run)
+            return None
+        regs = chip8.gen_regs
+        skip_if_equal = first_id == _SE_VX
+        skipped_pc = address + 4
+
+        def skip_jp():
+            if (regs[x] == kk) == skip_if_equal:
+                chip8.pc_reg = skipped_pc
+                return 1
+            chip8.pc_reg = target
+            return 2
+        return skip_jp
+
+    if first_id == _ADD_VX and second_id in (_SE_VX, _SNE_VX):
+        regs = chip8.gen_regs
+        compare_x, compare_kk = second[1], second[4]
+        skip_if_equal = second_id == _SE_VX
+        next_pc = address + 4
+
+        def add_skip():
+            regs[x] = (regs[x] + kk) & 0xFF
+            chip8.pc_reg = next_pc + 2 if (regs[compare_x] == compare_kk) == skip_if_equal else next_pc
+            return 2
+        return add_skip
+
+    return None
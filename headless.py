@@ -0,0 +1,186 @@
+"""Runs a rom without a display (pygame is never imported)
+
+Usage: python headless.py ROM (--cycles N | --frames N) [--ips N] [--engine ENGINE] [--seed N] [--trace]
+                          [--trace-file FILE [--trace-size N] [--trace-registers]] [--stats [--stats-sample N]]
+                          [--profile] [--profile-stacks FILE] [--image] [--fusion]
+
+ROM is either a path or the name of one of the roms in ROMS/. At the end the number of cycles per second and a hash
+of the final framebuffer are reported. With --trace-file the last executed instructions are kept in a ring buffer
+that is written to the file when the run ends, even if it ends with an error (decode it with tracing.py). With
+--stats a table of the executed instructions is printed at the end. With --profile the hottest guest addresses and
+subroutines are printed at the end, and --profile-stacks writes the guest call stacks as a collapsed stack file for
+flame graph tools. With --image the rom is loaded as a pre-decoded program image (see analyzer.py). --fusion turns
+on the superinstructions of the interpreter (see fusion.py).
+"""
+import argparse
+import hashlib
+import time
+from collections import namedtuple
+
+from analyzer import load_image
+from chip8 import Chip8State
+from instructions import get_decode_table
+from profiler import GuestProfiler
+from roms import read_rom
+from scheduler import DEFAULT_INSTRUCTIONS_PER_SECOND, Scheduler
+from stats import InstructionStats
+from tracing import TraceBuffer
+from translator import BlockTranslator
+
+# Execution engines by name. Each one takes the Chip8State to run, None means the Chip8State interpreter itself
+ENGINES = {
+    'interpreter': lambda chip8: None,
+    'translator': BlockTranslator,
+}
+
+# Cycles between two changes of a scripted input: a key is held for one period, then released for one period
+INPUT_PERIOD = 5000
+
+HeadlessResult = namedtuple('HeadlessResult', ['cycles', 'frames', 'seconds', 'cycles_per_second', 'framebuffer_hash'])
+
+
+def framebuffer_hash(chip8):
+    return hashlib.sha1(chip8.framebuffer_bytes()).hexdigest()
+
+
+def run_frames(chip8, scheduler, cycles=None, frames=None):
+    """Runs 60 Hz frames until either the cycle or the frame budget is used up"""
+    if frames is None:
+        scheduler.run_cycles(cycles - chip8.cycle_count)
+        return
+    while scheduler.frame_count < frames:
+        if cycles is None:
+            scheduler.run_frame()
+            continue
+        remaining = cycles - chip8.cycle_count
+        if remaining <= 0:
+            break
+        scheduler.run_cycles(min(remaining, scheduler.frame_cycles_left))
+
+
+def run_with_inputs(chip8, scheduler, inputs, cycles, deadline=None, slice_cycles=10000):
+    """Runs until cycle_count reaches cycles, applying an input script on the way
+
+    inputs is a sequence of (cycle, keypad_mask) pairs sorted by cycle: when cycle_count reaches cycle, the keypad is
+    set to keypad_mask (bit k set means key k is pressed). If a deadline (a time.perf_counter() value) is given, the
+    run stops once it has passed, checking every slice_cycles instructions. Returns False if the deadline stopped the
+    run, True otherwise.
+    """
+    events = iter(inputs)
+    event = next(events, None)
+    while chip8.cycle_count < cycles:
+        while event is not None and event[0] <= chip8.cycle_count:
+            chip8.set_keypad_mask(event[1])
+            event = next(events, None)
+        stop = cycles if event is None else min(cycles, event[0])
+        if deadline is not None:
+            stop = min(stop, chip8.cycle_count + slice_cycles)
+        scheduler.run_cycles(stop - chip8.cycle_count)
+        if deadline is not None and time.perf_counter() > deadline:
+            return chip8.cycle_count >= cycles
+    return True
+
+
+def scripted_inputs(keys, cycles, period=INPUT_PERIOD):
+    """Returns (cycle, keypad_mask) pairs pressing each of the keys in turn for period cycles, with pauses between"""
+    inputs = []
+    for i, cycle in enumerate(range(0, cycles, 2 * period)):
+        inputs.append((cycle, 1 << keys[i % len(keys)]))
+        inputs.append((cycle + period, 0))
+    return inputs
+
+
+def run_headless(rom_bytes, cycles=None, frames=None, instructions_per_second=DEFAULT_INSTRUCTIONS_PER_SECOND,
+                 trace=False, engine='interpreter', tracer=None, trace_file=None, stats=None,
+                 profiler=None, seed=None, program_image=None, fusion=False):
+    """Runs a rom until either the cycle or the frame budget is used up and returns a HeadlessResult
+
+    If a tracer (tracing.TraceBuffer) is given it records the executed instructions, and it is dumped to trace_file
+    (if given) at the end of the run or when the run fails. If stats (stats.InstructionStats) are given the executed
+    instructions are counted in them, and if a profiler (profiler.GuestProfiler) is given they are attributed to their
+    guest addresses and subroutines. seed seeds the random number generator of the machine. If a program_image
+    (analyzer.ProgramImage of rom_bytes) is given, the rom is loaded from it with its pre-decoded instructions. fusion
+    turns on the superinstructions of the interpreter.
+    """
+    if cycles is None and frames is None:
+        raise ValueError('either a cycle or a frame budget is needed')
+
+    chip8 = Chip8State()
+    chip8.initialise(seed)
+    if program_image is None:
+        chip8.load_rom(rom_bytes)
+        # Build the decode table up front so that it is not part of the measured time
+        get_decode_table()
+    else:
+        chip8.load_program_image(program_image)
+    chip8.fusion = fusion
+    chip8.trace = trace
+    chip8.tracer = tracer
+    chip8.stats = stats
+    chip8.profiler = profiler
+    scheduler = Scheduler(chip8, instructions_per_second, engine=ENGINES[engine](chip8))
+
+    time_start = time.perf_counter()
+    try:
+        run_frames(chip8, scheduler, cycles, frames)
+    finally:
+        if tracer is not None and trace_file is not None:
+            tracer.dump(trace_file)
+    seconds = time.perf_counter() - time_start
+
+    cycles_per_second = chip8.cycle_count / seconds if seconds > 0 else float('inf')
+    return HeadlessResult(chip8.cycle_count, scheduler.frame_count, seconds, cycles_per_second,
+                          framebuffer_hash(chip8))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a CHIP-8 rom without a display')
+    parser.add_argument('rom', help='path to a rom or name of one of the roms in ROMS/')
+    budget = parser.add_mutually_exclusive_group(required=True)
+    budget.add_argument('--cycles', type=int, help='number of instructions to execute')
+    budget.add_argument('--frames', type=int, help='number of 60 Hz frames to emulate')
+    parser.add_argument('--ips', type=int, default=DEFAULT_INSTRUCTIONS_PER_SECOND,
+                        help='emulated instructions per second (default: %(default)s)')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='interpreter',
+                        help='execution engine (default: %(default)s)')
+    parser.add_argument('--seed', type=int, help='seed of the random number generator (default: random)')
+    parser.add_argument('--trace', action='store_true', help='print every executed instruction')
+    parser.add_argument('--trace-file', help='record the last executed instructions and write them to this file')
+    parser.add_argument('--trace-size', type=int, default=4096,
+                        help='number of instructions kept for --trace-file (default: %(default)s)')
+    parser.add_argument('--trace-registers', action='store_true',
+                        help='also record the registers changed by each instruction for --trace-file')
+    parser.add_argument('--stats', action='store_true', help='count the executed instructions by kind')
+    parser.add_argument('--stats-sample', type=int, default=0,
+                        help='with --stats, also time one in N executions of each instruction (default: no timing)')
+    parser.add_argument('--profile', action='store_true', help='print the hottest guest addresses and subroutines')
+    parser.add_argument('--profile-stacks', help='write the guest call stacks to this file (collapsed stack format)')
+    parser.add_argument('--image', action='store_true',
+                        help='load the rom as a pre-decoded program image (cached on disk by analyzer.py)')
+    parser.add_argument('--fusion', action='store_true', help='execute common instruction pairs as one')
+    args = parser.parse_args(argv)
+
+    tracer = TraceBuffer(args.trace_size, args.trace_registers) if args.trace_file else None
+    stats = InstructionStats(args.stats_sample) if args.stats else None
+    profiler = GuestProfiler() if args.profile or args.profile_stacks else None
+    rom_bytes = read_rom(args.rom)
+    program_image = load_image(rom_bytes) if args.image else None
+    result = run_headless(rom_bytes, args.cycles, args.frames, args.ips, args.trace, args.engine, tracer,
+                          args.trace_file, stats, profiler, args.seed, program_image,
+                          args.fusion)
+    print('cycles: {}'.format(result.cycles))
+    print('frames: {}'.format(result.frames))
+    print('seconds: {:.3f}'.format(result.seconds))
+    print('cycles/sec: {:.0f}'.format(result.cycles_per_second))
+    print('framebuffer sha1: {}'.format(result.framebuffer_hash))
+    if stats is not None:
+        print(stats.summary())
+    if args.profile:
+        # The instructions are shown as loaded from the rom (the program could have modified them while running)
+        print(profiler.report(bytes(0x200) + rom_bytes))
+    if args.profile_stacks:
+        profiler.write_collapsed_stacks(args.profile_stacks)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,16 @@
+# Names of the 35 known instructions. The position of a name in this list is the id used by the decode table
+INSTRUCTION_NAMES = [
+    'CLS', 'RET', 'SYS', 'JP', 'CALL', 'SE_Vx', 'SNE_Vx', 'SE_Vy_Vy', 'LD_Vx', 'ADD_Vx',
+    'LD_Vx_Vy', 'OR_Vx_Vy', 'AND_Vx_Vy', 'XOR_Vx_Vy', 'ADD_Vx_Vy', 'SUB_Vx_Vy', 'SHR_Vx_Vy', 'SUBN_Vx_Vy',
+    'SHL_Vx_Vy', 'SNE_Vx_Vy', 'LD_I', 'JP_V0', 'RND_Vx', 'DRW_Vx_Vy', 'SKP_Vx', 'SKNP_Vx', 'LD_Vx_DT',
+    'LD_Vx_K', 'LD_DT_Vx', 'LD_ST_Vx', 'ADD_I_Vx', 'LD_F_Vx', 'LD_B_Vx', 'LD_I_Vx', 'LD_Vx_I',
+]
+INSTRUCTION_IDS = {name: inst_id for inst_id, name in enumerate(INSTRUCTION_NAMES)}
+
+# Lazily built table with one entry per 16 bit opcode (see get_decode_table)
+_decode_table = None
+
+
 def get_instruction_name(opcode):
     # Checking which one of 35 known instructions does the opcode belong to
     if opcode == 0x00E0:
@@ -76,6 +89,42 @@ def get_instruction_name(opcode):
     return inst_name
 
 
-def execute_instruction(instruction_name):
-    pass
+def decode(opcode):
+    """Decodes a single opcode
+
+    Returns a tuple (inst_id, x, y, n, kk, nnn) where inst_id is the position of the instruction name in
+    INSTRUCTION_NAMES and the rest are the operands already extracted from the opcode
+    (opcode = 0x?xyn = 0x?xkk = 0x?nnn).
+    Returns None if the opcode is not a valid instruction.
+    """
+    try:
+        inst_name = get_instruction_name(opcode)
+    except ValueError:
+        return None
+    x = (opcode & 0x0F00) >> 8
+    y = (opcode & 0x00F0) >> 4
+    return INSTRUCTION_IDS[inst_name], x, y, opcode & 0x000F, opcode & 0x00FF, opcode & 0x0FFF
+
+
+def get_decode_table():
+    """Returns the decode table for all 65536 opcodes, building it on first use
+
+    The table is a list indexed by the opcode, so decoding an instruction is a single lookup. Invalid opcodes map to
+    None.
+    """
+    global _decode_table
+    if _decode_table is None:
+        _decode_table = [decode(opcode) for opcode in range(0x10000)]
+    return _decode_table
+
+
+class SparseDecodeTable(dict):
+    """Decode table holding only some opcodes, decoding the others on first use
+
+    Can be used in place of the full table of get_decode_table (it is indexed the same way) when only a few opcodes
+    are ever executed, e.g. those of a single rom, which saves building the 65536 entries.
+    """
 
+    def __missing__(self, opcode):
+        entry = self[opcode] = decode(opcode)
+        return entry
@@ -1,121 +1,214 @@
 from chip8 import Chip8State
+from recording import start_recording
+from rewind import RewindBuffer
+from roms import read_rom
+from scheduler import DEFAULT_INSTRUCTIONS_PER_SECOND, PACING_POLICIES, TIMER_HZ, Pacer, Scheduler
+from threaded import EmulatorThread
+import argparse
 import pygame
 import sys
-import os
+
+# Held down to play the game backwards
+REWIND_KEY = pygame.K_BACKSPACE
+
+
+# Keyboard key of every CHIP-8 key (0x0 to 0xF)
+KEY_MAP = [pygame.K_1, pygame.K_2, pygame.K_3, pygame.K_4,
+           pygame.K_q, pygame.K_w, pygame.K_e, pygame.K_r,
+           pygame.K_a, pygame.K_s, pygame.K_d, pygame.K_f,
+           pygame.K_z, pygame.K_x, pygame.K_c, pygame.K_v]
+
+
+def keys_to_mask(keys):
+    # 16 bit mask of the CHIP-8 keys held down on the keyboard
+    mask = 0
+    for key, keyboard_key in enumerate(KEY_MAP):
+        if keys[keyboard_key]:
+            mask |= 1 << key
+    return mask
 
 
 def update_keypad(chip8, keys):
-    chip8.keypad[0] = keys[pygame.K_1]
-    chip8.keypad[1] = keys[pygame.K_2]
-    chip8.keypad[2] = keys[pygame.K_3]
-    chip8.keypad[3] = keys[pygame.K_4]
-    chip8.keypad[4] = keys[pygame.K_q]
-    chip8.keypad[5] = keys[pygame.K_w]
-    chip8.keypad[6] = keys[pygame.K_e]
-    chip8.keypad[7] = keys[pygame.K_r]
-    chip8.keypad[8] = keys[pygame.K_a]
-    chip8.keypad[9] = keys[pygame.K_s]
-    chip8.keypad[10] = keys[pygame.K_d]
-    chip8.keypad[11] = keys[pygame.K_f]
-    chip8.keypad[12] = keys[pygame.K_z]
-    chip8.keypad[13] = keys[pygame.K_x]
-    chip8.keypad[14] = keys[pygame.K_c]
-    chip8.keypad[15] = keys[pygame.K_v]
-
-
-def refresh_screen(chip8, buffer, white, black):
-    for x in range(chip8.width):
-        for y in range(chip8.height):
-            if chip8.display[x][y] == 1:
-                buffer.set_at((x, y), white)
-            else:
-                buffer.set_at((x, y), black)
-
-
-def main():
-    # Reading the rom data from file
-    filename = 'PongForOne.ch8'
-
-    basedir = os.path.dirname(__file__)
-    filepath = os.path.join(basedir, 'ROMS', filename)
-    with open(filepath, 'rb') as f:
-        rom_bytes = f.read()
+    # Through set_keypad_mask, so that a machine waiting for a key (LD_Vx_K) is woken up as soon as one is pressed
+    chip8.set_keypad_mask(keys_to_mask(keys))
+
+
+def make_pixel_table(white, black):
+    # Maps every byte of the packed display (8 pixels) to the 8 RGB pixels (24 bytes) it stands for
+    table = []
+    for byte in range(256):
+        table.append(b''.join(bytes(white if (byte >> (7 - bit)) & 1 else black) for bit in range(8)))
+    return table
+
+
+def draw_frame(frame, resolution, window, scaled_res, pixel_table):
+    # Build the whole 64x32 RGB image of the packed display at once and upload it in a single call instead of one
+    # set_at per pixel
+    pixels = b''.join([pixel_table[byte] for byte in frame])
+    buffer = pygame.image.frombuffer(pixels, resolution, 'RGB')
+    pygame.transform.scale(buffer, scaled_res, window)
+    pygame.display.flip()
+
+
+def refresh_screen(chip8, window, scaled_res, pixel_table):
+    draw_frame(chip8.framebuffer_bytes(), (chip8.width, chip8.height), window, scaled_res, pixel_table)
+
+
+def quit_pygame():
+    pygame.display.quit()
+    pygame.quit()
+    sys.exit()
+
+
+def caption(scheduler, pacer):
+    return "CHIP8 ({} dropped frames, wakes up {:.1f} ms late)".format(scheduler.dropped_frames, 1000 * pacer.mean_lag)
+
+
+def run_threaded(scheduler, pacing, rewind_buffer, recording, resolution, window, scaled_res, pixel_table):
+    # The cpu runs on its own thread (see threaded.py) while this one presents its frames and reads the keyboard, both
+    # at 60 Hz
+    emulator = EmulatorThread(scheduler, pacing, rewind_buffer, recording)
+    emulator.start()
+    pacer = Pacer(TIMER_HZ)
+    # Frame generation last drawn on the window, -1 so that the first published frame is always drawn
+    drawn_generation = -1
+    while True:
+        pacer.wait()
+        events = pygame.event.get()
+
+        # Show how many frames the emulation dropped to keep up with real time, and how late the cpu thread wakes up
+        # for its frames, once per second
+        if pacer.frames % TIMER_HZ == 0:
+            pygame.display.set_caption(caption(scheduler, emulator.pacer))
+
+        if not emulator.is_alive() or any(event.type == pygame.QUIT for event in events):
+            emulator.stop()
+            return emulator
+
+        keys = pygame.key.get_pressed()
+        # Rewinding is off while recording (see main)
+        emulator.rewinding = bool(keys[REWIND_KEY]) and recording is None
+        emulator.keypad_mask = keys_to_mask(keys)
+
+        latest = emulator.frames.latest(drawn_generation)
+        if latest is not None:
+            drawn_generation, frame = latest
+            draw_frame(frame, resolution, window, scaled_res, pixel_table)
+
+
+def main(filename='PongForOne.ch8', instructions_per_second=DEFAULT_INSTRUCTIONS_PER_SECOND, record_file=None,
+         seed=None, pacing='sleep', threaded=False):
+    # Reading the rom data from file (either a path or the name of one of the roms in ROMS/)
+    rom_bytes = read_rom(filename)
 
     # Creating an instance of Chip8
     chip8 = Chip8State()
 
-    # Set initial Chip8 states
-    chip8.initialise()
-
-    # Load the ROM in memory
-    chip8.load_rom(rom_bytes)
+    # Set initial Chip8 states and load the ROM in memory. When recording, the keypad changes are saved to record_file
+    # on exit, to be replayed with recording.py
+    recording = None
+    if record_file is None:
+        chip8.initialise(seed)
+        chip8.load_rom(rom_bytes)
+    else:
+        recording = start_recording(chip8, filename, rom_bytes, seed, instructions_per_second)
 
     # Set up display and input systems using pygame
     pygame.init()
     white = (255, 255, 255)
     black = (0, 0, 0)
     scale = 20
-    clock = pygame.time.Clock()
+    # Sleeps until every 60 Hz frame deadline (see scheduler.PACING_POLICIES for the other policies)
+    pacer = Pacer(TIMER_HZ, pacing)
     resolution = (chip8.width, chip8.height)
-    buf = pygame.Surface(resolution)
+    pixel_table = make_pixel_table(white, black)
     scaled_res = (resolution[0] * scale, resolution[1] * scale)
     window = pygame.display.set_mode(scaled_res)
     pygame.display.set_caption("CHIP8")
 
+    # Runs the cpu in batches of instructions, one batch per 60 Hz frame
+    scheduler = Scheduler(chip8, instructions_per_second)
+
+    # The state of every frame is recorded. Holding the rewind key plays the game backwards one frame per refresh
+    rewind_buffer = RewindBuffer()
+
+    if threaded:
+        emulator = run_threaded(scheduler, pacing, rewind_buffer, recording, resolution, window, scaled_res,
+                                pixel_table)
+        # The cpu thread has stopped, the chip8 is this thread's again
+        if recording is not None:
+            recording.finish(chip8)
+            recording.save(record_file)
+        print(emulator.pacer.summary())
+        quit_pygame()
+
+    rewind_buffer.record(chip8)
+
     # Emulate cycles
-    x = 0
-    y = 0
-    import time
-    time_start = time.time()
+    # Display generation last drawn on the window, -1 so that the first frame is always drawn
+    drawn_generation = -1
     while True:
-        x += 1
-        y += 1
-        clock.tick()  # Execute for loop n times per second
+        # Wait for the next display refresh. Returns the real time (in seconds) since the last one. The events are
+        # polled once per refresh
+        elapsed = pacer.wait()
         events = pygame.event.get()
 
-        # if x >= 10000:
-        #     pygame.display.quit()
-        #     pygame.quit()
-        #     sys.exit()
+        # Show how many frames the emulation dropped to keep up with real time, and how late the loop wakes up for its
+        # frames, once per second
+        if pacer.frames % TIMER_HZ == 0:
+            pygame.display.set_caption(caption(scheduler, pacer))
 
         # Check if game is closed
         for event in events:
             if event.type == pygame.QUIT:
-                pygame.display.quit()
-                pygame.quit()
-                sys.exit()
+                if recording is not None:
+                    recording.finish(chip8)
+                    recording.save(record_file)
+                print(pacer.summary())
+                quit_pygame()
 
         # Read the key pressed info from pygame and change the keypad state
         keys = pygame.key.get_pressed()
-        update_keypad(chip8, keys)
-
-        # Emulate a cpu cycle (fetch-decode-execute)
-        chip8.cpu_cycle()
-
-        # Refresh the screen using pygame
-        refresh_screen(chip8, buf, white, black)
-
-        # TODO: What does this do
-        pygame.transform.scale(buf, scaled_res, window)
-        buf.fill(black)
-        pygame.display.flip()
-        clock.tick()
-
-        # Decrement the delay timer
-        if chip8.delay_timer > 0:
-            chip8.delay_timer += -1
 
-        # if time.time() - time_start > 1:
-        #     print(y)
-        #     y = 0
-        #     time_start = time.time()
+        # Rewinding is off while recording, the random number generator is not part of the rewound state so the
+        # recording could not be replayed
+        if keys[REWIND_KEY] and recording is None:
+            rewind_buffer.rewind(chip8)
+        else:
+            update_keypad(chip8, keys)
+            if recording is not None:
+                recording.record(chip8)
+            # Emulate the frames (batches of fetch-decode-execute cycles plus a timer tick) due in the elapsed time
+            if scheduler.advance(elapsed):
+                rewind_buffer.record(chip8)
+
+        # Refresh the screen using pygame, at most once per display refresh and only if the display changed since it
+        # was last drawn
+        if chip8.display_generation != drawn_generation:
+            refresh_screen(chip8, window, scaled_res, pixel_table)
+            drawn_generation = chip8.display_generation
 
 
 if __name__ == "__main__":
     # For pong multiplayer
     # For left player: 2-> Move up, q-> Move down,
     # For right player: z-> Move up, x->Move down
-    main()
+    # Backspace-> Rewind
+    # Usage: python main.py [ROM] [--ips N] [--record FILE] [--pacing POLICY] [--threaded]
+    # With --record the session is recorded to that file, replay it with: python recording.py FILE
+    parser = argparse.ArgumentParser(description='Play a CHIP-8 rom')
+    parser.add_argument('rom', nargs='?', default='PongForOne.ch8',
+                        help='path to a rom or name of one of the roms in ROMS/ (default: %(default)s)')
+    parser.add_argument('--ips', type=int, default=DEFAULT_INSTRUCTIONS_PER_SECOND,
+                        help='emulated instructions per second (default: %(default)s)')
+    parser.add_argument('--record', help='record the session to this file')
+    parser.add_argument('--pacing', choices=PACING_POLICIES, default='sleep',
+                        help='how to wait between frames: sleep (least cpu), hybrid or busy (least latency) '
+                             '(default: %(default)s)')
+    parser.add_argument('--threaded', action='store_true',
+                        help='run the cpu on its own thread, apart from the window (see threaded.py)')
+    args = parser.parse_args()
+    main(args.rom, args.ips, args.record, pacing=args.pacing, threaded=args.threaded)
 
 
 
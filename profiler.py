@@ -0,0 +1,89 @@
+"""Guest program profiler: attributes executed cycles to guest addresses and subroutines
+
+Enable it on a Chip8State by setting its profiler (chip8.profiler = GuestProfiler()). Every executed instruction is
+counted at its address, and at the current call stack of the guest program, which is followed through CALL and RET.
+The code outside of any subroutine is attributed to the entry point (0x200).
+
+From the call stack counts come the inclusive (the subroutine and everything it calls) and exclusive (the subroutine
+alone) cycle counts of every subroutine, and a collapsed stack file in the format read by flame graph tools
+(one 'frame;frame;frame count' line per stack).
+"""
+from collections import defaultdict
+
+from instructions import INSTRUCTION_IDS, get_instruction_name
+
+_CALL = INSTRUCTION_IDS['CALL']
+_RET = INSTRUCTION_IDS['RET']
+
+
+class GuestProfiler:
+    def __init__(self, entry_point=0x200):
+        # Executed instructions by address
+        self.pc_hits = [0] * 4096
+        # Executed instructions by call stack (a tuple of subroutine addresses, outermost first)
+        self.stack_cycles = defaultdict(int)
+        self.calls = defaultdict(int)
+        self._stack = (entry_point,)
+
+    def record(self, pc, inst_id, nnn):
+        """Counts one executed instruction. CALL counts in the caller and RET in the subroutine it returns from"""
+        self.pc_hits[pc] += 1
+        self.stack_cycles[self._stack] += 1
+        if inst_id == _CALL:
+            self._stack = self._stack + (nnn,)
+            self.calls[nnn] += 1
+        elif inst_id == _RET and len(self._stack) > 1:
+            self._stack = self._stack[:-1]
+
+    def subroutine_cycles(self):
+        """Returns {address: (inclusive, exclusive)} cycle counts per subroutine"""
+        inclusive = defaultdict(int)
+        exclusive = defaultdict(int)
+        for stack, cycles in self.stack_cycles.items():
+            exclusive[stack[-1]] += cycles
+            # A recursive subroutine is only counted once per stack
+            for address in set(stack):
+                inclusive[address] += cycles
+        return {address: (inclusive[address], exclusive[address]) for address in inclusive}
+
+    def collapsed_stacks(self):
+        """Returns the call stack counts in the collapsed stack format of flame graph tools"""
+        lines = []
+        for stack, cycles in sorted(self.stack_cycles.items()):
+            lines.append('{} {}'.format(';'.join('0x{:03x}'.format(address) for address in stack), cycles))
+        return '\n'.join(lines) + '\n'
+
+    def write_collapsed_stacks(self, path):
+        with open(path, 'w') as f:
+            f.write(self.collapsed_stacks())
+
+    def report(self, memory=None, top=20):
+        """Returns a text report of the hottest addresses and subroutines
+
+        With the memory of the profiled machine, the instruction currently at each hot address is shown too.
+        """
+        total = sum(self.pc_hits)
+        lines = ['Hottest addresses', '{:<7} {:>12} {:>7}  {}'.format('address', 'cycles', '%', 'instruction')]
+        hot = sorted((address for address in range(len(self.pc_hits)) if self.pc_hits[address]),
+                     key=lambda address: self.pc_hits[address], reverse=True)
+        for address in hot[:top]:
+            instruction = ''
+            if memory is not None and address + 1 < len(memory):
+                opcode = (memory[address] << 8) | memory[address + 1]
+                try:
+                    instruction = '{:04x} {}'.format(opcode, get_instruction_name(opcode))
+                except ValueError:
+                    instruction = '{:04x} ???'.format(opcode)
+            lines.append('0x{:03x}   {:>12} {:>7.2f}  {}'.format(address, self.pc_hits[address],
+                                                                100 * self.pc_hits[address] / total, instruction))
+
+        lines.append('')
+        lines.append('Subroutines')
+        lines.append('{:<7} {:>10} {:>12} {:>7} {:>12} {:>7}'.format('address', 'calls', 'inclusive', '%',
+                                                                       'exclusive', '%'))
+        subroutines = self.subroutine_cycles()
+        for address in sorted(subroutines, key=lambda address: subroutines[address][0], reverse=True)[:top]:
+            inclusive, exclusive = subroutines[address]
+            lines.append('0x{:03x}   {:>10} {:>12} {:>7.2f} {:>12} {:>7.2f}'.format(
+                address, self.calls[address], inclusive, 100 * inclusive / total, exclusive, 100 * exclusive / total))
+        return '\n'.join(lines)
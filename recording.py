@@ -0,0 +1,155 @@
+"""Records the keypad of a session and replays it headless at full speed
+
+A recording holds everything needed to run a session again: the rom (name and sha1), the seed of the random number
+generator, the instructions per second, and every change of the keypad with the cycle at which it happened. A run
+applies them at the same cycles (see headless.run_with_inputs) and so ends with the same framebuffer, which is saved
+along with the final cycle count to check replays against.
+
+Usage: python recording.py RECORDING [--rom ROM]
+
+Replays a recording as fast as possible and checks that it ends with the recorded framebuffer. ROM overrides the rom
+named in the recording (it still has to have the same sha1).
+
+File format (little endian): a '<4sBQI20sQ20sH' header (magic C8IN, version, seed, instructions per second, rom sha1,
+final cycle count, final framebuffer sha1, length of the rom name), the rom name (utf-8), the number of keypad changes
+(uint32), then each change as the number of cycles since the previous one (uint32) and the keypad mask (uint16).
+"""
+import argparse
+import hashlib
+import random
+import struct
+import sys
+import time
+
+from chip8 import Chip8State
+from headless import framebuffer_hash, run_with_inputs
+from instructions import get_decode_table
+from roms import read_rom
+from scheduler import DEFAULT_INSTRUCTIONS_PER_SECOND, Scheduler
+
+RECORDING_MAGIC = b'C8IN'
+RECORDING_VERSION = 1
+_HEADER = struct.Struct('<4sBQI20sQ20sH')
+_COUNT = struct.Struct('<I')
+_EVENT = struct.Struct('<IH')
+
+
+class InputRecording:
+    def __init__(self, rom_name, rom_sha1, seed, instructions_per_second=DEFAULT_INSTRUCTIONS_PER_SECOND):
+        self.rom_name = rom_name
+        # Digest (20 bytes) of the rom
+        self.rom_sha1 = rom_sha1
+        self.seed = seed
+        self.instructions_per_second = instructions_per_second
+        # (cycle, keypad_mask) pairs sorted by cycle
+        self.inputs = []
+        # Set by finish
+        self.cycles = 0
+        self.framebuffer_sha1 = bytes(20)
+
+    def record(self, chip8):
+        """Records the keypad of chip8 if it changed since it was last recorded. Call it whenever the keypad is set"""
+        mask = chip8.keypad_mask()
+        if self.inputs and self.inputs[-1][1] == mask:
+            return
+        if not self.inputs and mask == 0:
+            # The keypad starts with no key pressed
+            return
+        self.inputs.append((chip8.cycle_count, mask))
+
+    def finish(self, chip8):
+        """Saves the final cycle count and framebuffer of the session"""
+        self.cycles = chip8.cycle_count
+        self.framebuffer_sha1 = bytes.fromhex(framebuffer_hash(chip8))
+
+    def save(self, path):
+        name = self.rom_name.encode('utf-8')
+        parts = [_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, self.seed, self.instructions_per_second,
+                              self.rom_sha1, self.cycles, self.framebuffer_sha1, len(name)),
+                 name, _COUNT.pack(len(self.inputs))]
+        previous = 0
+        for cycle, mask in self.inputs:
+            parts.append(_EVENT.pack(cycle - previous, mask))
+            previous = cycle
+        with open(path, 'wb') as f:
+            f.write(b''.join(parts))
+
+
+def start_recording(chip8, rom_name, rom_bytes, seed=None, instructions_per_second=DEFAULT_INSTRUCTIONS_PER_SECOND):
+    """Initialises chip8 with a (random if not given) seed, loads the rom and returns the recording of the session"""
+    if seed is None:
+        seed = random.getrandbits(64)
+    chip8.initialise(seed)
+    chip8.load_rom(rom_bytes)
+    return InputRecording(rom_name, hashlib.sha1(rom_bytes).digest(), seed, instructions_per_second)
+
+
+def load_recording(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    (magic, version, seed, instructions_per_second, rom_sha1, cycles, framebuffer_sha1,
+     name_length) = _HEADER.unpack_from(data)
+    if magic != RECORDING_MAGIC:
+        raise ValueError('{} is not an input recording'.format(path))
+    if version != RECORDING_VERSION:
+        raise ValueError('unsupported input recording version {}'.format(version))
+    offset = _HEADER.size
+    rom_name = data[offset: offset + name_length].decode('utf-8')
+    offset += name_length
+    count, = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+
+    recording = InputRecording(rom_name, rom_sha1, seed, instructions_per_second)
+    recording.cycles = cycles
+    recording.framebuffer_sha1 = framebuffer_sha1
+    cycle = 0
+    for delta, mask in _EVENT.iter_unpack(data[offset: offset + count * _EVENT.size]):
+        cycle += delta
+        recording.inputs.append((cycle, mask))
+    return recording
+
+
+def replay(recording, rom_bytes=None):
+    """Runs a recorded session as fast as possible and returns the Chip8State at its end
+
+    rom_bytes defaults to the rom named in the recording. Raises ValueError if the rom is not the recorded one.
+    """
+    if rom_bytes is None:
+        rom_bytes = read_rom(recording.rom_name)
+    if hashlib.sha1(rom_bytes).digest() != recording.rom_sha1:
+        raise ValueError('the rom is not the one of the recording')
+    chip8 = Chip8State()
+    chip8.initialise(recording.seed)
+    chip8.load_rom(rom_bytes)
+    scheduler = Scheduler(chip8, recording.instructions_per_second)
+    run_with_inputs(chip8, scheduler, recording.inputs, recording.cycles)
+    return chip8
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a recorded CHIP-8 session without a display')
+    parser.add_argument('recording', help='recording written by main.py')
+    parser.add_argument('--rom', help='path to the rom (default: the rom named in the recording)')
+    args = parser.parse_args(argv)
+
+    recording = load_recording(args.recording)
+    rom_bytes = read_rom(args.rom or recording.rom_name)
+    get_decode_table()
+    time_start = time.perf_counter()
+    chip8 = replay(recording, rom_bytes)
+    seconds = time.perf_counter() - time_start
+
+    final_hash = framebuffer_hash(chip8)
+    print('rom: {}'.format(recording.rom_name))
+    print('cycles: {}'.format(chip8.cycle_count))
+    print('keypad changes: {}'.format(len(recording.inputs)))
+    print('seconds: {:.3f}'.format(seconds))
+    print('framebuffer sha1: {}'.format(final_hash))
+    if final_hash != recording.framebuffer_sha1.hex():
+        print('MISMATCH: the recorded framebuffer sha1 is {}'.format(recording.framebuffer_sha1.hex()))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""Rewind buffer: keeps the recent states of a machine (one per frame) in a bounded amount of memory
+
+Every keyframe_interval frames a full snapshot (Chip8State.snapshot) is kept as a keyframe, the frames in between
+are kept as the XOR of their snapshot with the keyframe before them. Consecutive frames differ in a handful of bytes,
+so the deltas are mostly zeros, and successive deltas mostly repeat each other. The deltas of a keyframe are
+compressed (zlib) together once the next keyframe is taken, which gets a frame down to a few dozen bytes (a few MB
+per hour at 60 frames per second). Any frame is rebuilt from its keyframe and its own delta.
+
+When the frames take more than max_bytes, the oldest keyframe is dropped along with its deltas (the newest keyframe is
+always kept).
+"""
+import zlib
+from collections import deque
+
+# 60 frames per second
+DEFAULT_KEYFRAME_INTERVAL = 60
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+
+def _xor(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+class _Group:
+    # A keyframe and the deltas of the frames that follow it. The deltas of the newest group are kept uncompressed in
+    # a list until the group is closed, then they are compressed together in a single blob
+    __slots__ = ('keyframe', 'deltas', 'frames', 'size')
+
+    def __init__(self, keyframe):
+        self.keyframe = keyframe
+        self.deltas = []
+        self.frames = 1
+        self.size = len(keyframe)
+
+
+class RewindBuffer:
+    def __init__(self, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, max_bytes=DEFAULT_MAX_BYTES, level=6):
+        if keyframe_interval < 1:
+            raise ValueError('keyframe interval must be at least 1')
+        self.keyframe_interval = keyframe_interval
+        self.max_bytes = max_bytes
+        # zlib compression level
+        self.level = level
+        self._groups = deque()
+        # Uncompressed snapshot of the newest keyframe, the deltas of new frames are taken against it
+        self._keyframe = None
+        self._frames = 0
+        self._bytes = 0
+
+    def __len__(self):
+        """Number of frames that can be restored"""
+        return self._frames
+
+    @property
+    def size(self):
+        """Bytes taken by the recorded frames"""
+        return self._bytes
+
+    def clear(self):
+        self._groups.clear()
+        self._keyframe = None
+        self._frames = 0
+        self._bytes = 0
+
+    def record(self, chip8):
+        """Records the current state of chip8 as the newest frame"""
+        snapshot = chip8.snapshot()
+        groups = self._groups
+        if self._keyframe is None or groups[-1].frames >= self.keyframe_interval:
+            if groups:
+                self._close(groups[-1])
+            group = _Group(zlib.compress(snapshot, self.level))
+            groups.append(group)
+            self._keyframe = snapshot
+            self._bytes += group.size
+        else:
+            group = groups[-1]
+            group.deltas.append(_xor(snapshot, self._keyframe))
+            group.frames += 1
+            group.size += len(snapshot)
+            self._bytes += len(snapshot)
+        self._frames += 1
+
+        # Drop the oldest groups, but always keep the newest one
+        while self._bytes > self.max_bytes and len(groups) > 1:
+            oldest = groups.popleft()
+            self._bytes -= oldest.size
+            self._frames -= oldest.frames
+
+    def _close(self, group):
+        # Compresses the deltas of a group that gets no more frames
+        if not group.deltas:
+            group.deltas = None
+            return
+        raw_size = sum(len(delta) for delta in group.deltas)
+        group.deltas = zlib.compress(b''.join(group.deltas), self.level)
+        group.size += len(group.deltas) - raw_size
+        self._bytes += len(group.deltas) - raw_size
+
+    def seek(self, frames_back=0):
+        """Returns the snapshot recorded frames_back frames before the newest one (0 is the newest)"""
+        if not 0 <= frames_back < self._frames:
+            raise IndexError('only {} frames recorded'.format(self._frames))
+        # Walk the groups from the newest one
+        for group in reversed(self._groups):
+            if frames_back < group.frames:
+                break
+            frames_back -= group.frames
+        position = group.frames - 1 - frames_back
+
+        if group is self._groups[-1]:
+            if position == 0:
+                return self._keyframe
+            return _xor(group.deltas[position - 1], self._keyframe)
+        keyframe = zlib.decompress(group.keyframe)
+        if position == 0:
+            return keyframe
+        size = len(keyframe)
+        deltas = zlib.decompress(group.deltas)
+        return _xor(deltas[(position - 1) * size: position * size], keyframe)
+
+    def rewind(self, chip8, frames=1):
+        """Restores chip8 to the state recorded frames frames before the newest one and forgets the newer frames
+
+        Stops at the oldest frame if fewer were recorded. Returns the number of frames actually rewound.
+        """
+        frames = min(frames, self._frames - 1)
+        if frames < 0:
+            return 0
+        snapshot = self.seek(frames)
+        self._truncate(frames)
+        chip8.restore(snapshot)
+        return frames
+
+    def _truncate(self, frames):
+        # Drops the newest frames. The newest remaining group is reopened so that it can get new frames
+        groups = self._groups
+        while frames >= groups[-1].frames:
+            group = groups.pop()
+            frames -= group.frames
+            self._frames -= group.frames
+            self._bytes -= group.size
+        group = groups[-1]
+        if not isinstance(group.deltas, list):
+            self._reopen(group)
+        if frames:
+            for delta in group.deltas[-frames:]:
+                group.size -= len(delta)
+                self._bytes -= len(delta)
+            del group.deltas[-frames:]
+            group.frames -= frames
+            self._frames -= frames
+
+    def _reopen(self, group):
+        # Decompresses the keyframe and deltas of a closed group
+        self._keyframe = zlib.decompress(group.keyframe)
+        size = len(self._keyframe)
+        compressed_size = 0
+        deltas = []
+        if group.deltas is not None:
+            compressed_size = len(group.deltas)
+            raw = zlib.decompress(group.deltas)
+            deltas = [raw[i: i + size] for i in range(0, len(raw), size)]
+        group.deltas = deltas
+        raw_size = len(deltas) * size
+        group.size += raw_size - compressed_size
+        self._bytes += raw_size - compressed_size
@@ -0,0 +1,19 @@
+import os
+
+# Directory with the bundled roms
+ROM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ROMS')
+
+
+def resolve_rom_path(name):
+    """Returns the path of a rom given either a path to it or the name of one of the roms in ROMS/"""
+    if os.path.isfile(name):
+        return name
+    path = os.path.join(ROM_DIR, name)
+    if os.path.isfile(path):
+        return path
+    raise FileNotFoundError('rom {} not found (looked for a file and in {})'.format(name, ROM_DIR))
+
+
+def read_rom(name):
+    with open(resolve_rom_path(name), 'rb') as f:
+        return f.read()
@@ -0,0 +1,187 @@
+import time
+
+TIMER_HZ = 60  # The delay and sound timers count down 60 times per second
+DEFAULT_INSTRUCTIONS_PER_SECOND = 700
+
+
+class Scheduler:
+    """Runs a Chip8State at a fixed number of instructions per second
+
+    Emulated time is split into 60 Hz frames. Every frame executes a batch of instructions and then ticks the timers
+    once, so the game speed only depends on the emulated clock and not on how fast the host renders.
+    """
+
+    def __init__(self, chip8, instructions_per_second=DEFAULT_INSTRUCTIONS_PER_SECOND, max_catch_up_frames=5,
+                 engine=None):
+        self.chip8 = chip8
+        # Executes the instructions through its run(cycles) method. Defaults to the chip8 interpreter itself, can be
+        # another engine running the same chip8, like translator.BlockTranslator
+        self.engine = chip8 if engine is None else engine
+        self.instructions_per_second = instructions_per_second
+        # If the host falls behind by more than this many frames, the extra frames are dropped instead of being run
+        # in a burst
+        self.max_catch_up_frames = max_catch_up_frames
+        self.frame_count = 0
+        # Frames of real time dropped by advance because the host fell too far behind
+        self.dropped_frames = 0
+        # Fraction of an instruction carried over to the next frame when instructions_per_second is not a multiple of
+        # TIMER_HZ
+        self._cycle_credit = 0.0
+        # Instructions left in the frame in progress. A frame can be run in several pieces (see run_cycles)
+        self._in_frame = False
+        self._frame_cycles_left = 0
+        # Real time (in seconds) that has passed but is not emulated yet
+        self._pending_time = 0.0
+
+    @property
+    def pending_time(self):
+        """Real time (in seconds) that has passed but is not emulated yet: how far the emulation is behind"""
+        return self._pending_time
+
+    @property
+    def frame_cycles_left(self):
+        """Number of instructions left before the next timer tick"""
+        if self._in_frame:
+            return self._frame_cycles_left
+        return int(self._cycle_credit + self.instructions_per_second / TIMER_HZ)
+
+    def run_frame(self):
+        """Emulates the rest of the current 60 Hz frame (a whole one if none is in progress) and ticks the timers"""
+        if not self._in_frame:
+            self._start_frame()
+        self._run_batch(self._frame_cycles_left)
+
+    def run_cycles(self, cycles):
+        """Executes the given number of instructions, ticking the timers every time a frame is completed"""
+        while cycles > 0:
+            if not self._in_frame:
+                self._start_frame()
+            batch = min(cycles, self._frame_cycles_left)
+            self._run_batch(batch)
+            cycles -= batch
+
+    def advance(self, elapsed):
+        """Emulates elapsed seconds of real time. Returns the number of frames that were run"""
+        self._pending_time += elapsed
+        frames = int(self._pending_time * TIMER_HZ)
+        if frames > self.max_catch_up_frames:
+            self.dropped_frames += frames - self.max_catch_up_frames
+            frames = self.max_catch_up_frames
+            self._pending_time = 0.0
+        else:
+            self._pending_time -= frames / TIMER_HZ
+        for _ in range(frames):
+            self.run_frame()
+        return frames
+
+    def _start_frame(self):
+        credit = self._cycle_credit + self.instructions_per_second / TIMER_HZ
+        self._frame_cycles_left = int(credit)
+        self._cycle_credit = credit - self._frame_cycles_left
+        self._in_frame = True
+
+    def _run_batch(self, cycles):
+        self.engine.run(cycles)
+        self._frame_cycles_left -= cycles
+        if self._frame_cycles_left == 0:
+            self.chip8.tick_timers()
+            self.frame_count += 1
+            self._in_frame = False
+
+
+# How Pacer.wait waits for the next frame:
+# - 'sleep': sleeps until the deadline. Lowest cpu use, but the os may wake it up to a millisecond or two late
+# - 'hybrid': sleeps until shortly before the deadline, then spins until it. On time, for a little cpu
+# - 'busy': spins until the deadline. The most precise, but uses a whole core
+PACING_POLICIES = ('sleep', 'hybrid', 'busy')
+
+
+class FrameLag:
+    """Statistics of how late after their deadlines the frames of a real time loop started, lag being the one of the
+    last frame
+
+    This is how late the loop wakes up, never negative as the loop doesn't start a frame before its deadline. How far
+    the emulation itself is behind real time is up to the scheduler (see Scheduler.pending_time and dropped_frames).
+    """
+
+    def __init__(self, period, max_lag_frames=5):
+        self.period = period
+        # If the loop falls behind by more than this many frames, its deadlines move to now instead of running the
+        # missed frames late (the scheduler drops them too, see Scheduler.max_catch_up_frames)
+        self.max_lag_frames = max_lag_frames
+        self.frames = 0
+        self.late_frames = 0
+        self.resyncs = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._total_lag = 0.0
+
+    def record_lag(self, lag):
+        """Counts a frame that started lag seconds after its deadline. Returns True if the deadlines have to move to
+        now (see max_lag_frames)"""
+        self.frames += 1
+        self.lag = lag
+        self._total_lag += lag
+        if lag > self.max_lag:
+            self.max_lag = lag
+        if lag > self.period:
+            self.late_frames += 1
+        if lag > self.max_lag_frames * self.period:
+            self.resyncs += 1
+            return True
+        return False
+
+    @property
+    def mean_lag(self):
+        return self._total_lag / self.frames if self.frames else 0.0
+
+
+class Pacer(FrameLag):
+    """Paces a real time loop at a fixed rate (60 Hz by default) and measures how well it keeps up (see FrameLag)
+
+    Frame deadlines are kept on a fixed grid (the first wait starts it), so a late frame does not delay the following
+    ones.
+    """
+
+    def __init__(self, hz=TIMER_HZ, policy='sleep', spin_margin=0.002, max_lag_frames=5):
+        if policy not in PACING_POLICIES:
+            raise ValueError('unknown pacing policy {}'.format(policy))
+        super().__init__(1 / hz, max_lag_frames)
+        self.policy = policy
+        # Time before the deadline at which the 'hybrid' policy stops sleeping and starts spinning
+        self.spin_margin = spin_margin
+        self._deadline = None
+        self._last = None
+
+    def wait(self):
+        """Waits for the next frame deadline and returns the real time (in seconds) since the previous wait returned"""
+        now = time.perf_counter()
+        if self._deadline is None:
+            self._deadline = self._last = now
+        else:
+            self._deadline += self.period
+            remaining = self._deadline - now
+            if self.policy == 'sleep':
+                if remaining > 0:
+                    time.sleep(remaining)
+            elif self.policy == 'hybrid':
+                if remaining > self.spin_margin:
+                    time.sleep(remaining - self.spin_margin)
+                while time.perf_counter() < self._deadline:
+                    pass
+            else:
+                while time.perf_counter() < self._deadline:
+                    pass
+            now = time.perf_counter()
+
+        if self.record_lag(now - self._deadline):
+            self._deadline = now
+
+        elapsed = now - self._last
+        self._last = now
+        return elapsed
+
+    def summary(self):
+        return ('{} frames, lag {:.2f} ms (mean {:.2f} ms, max {:.2f} ms), {} late frames, {} resyncs'.format(
+            self.frames, 1000 * self.lag, 1000 * self.mean_lag, 1000 * self.max_lag, self.late_frames,
+            self.resyncs))
@@ -0,0 +1,62 @@
+"""Per instruction execution counters and host time measurements
+
+Enable it on a Chip8State by setting its stats (chip8.stats = InstructionStats()). Every executed instruction is then
+counted by kind (one of the 35 instructions). With sample_every=N, one in every N executions of each instruction is
+also timed with time.perf_counter_ns, which gives the mean host time per instruction kind at a fraction of the cost of
+timing all of them.
+"""
+from instructions import INSTRUCTION_NAMES
+
+
+class InstructionStats:
+    def __init__(self, sample_every=0):
+        # Time one in sample_every executions of each instruction, 0 disables the timing
+        self.sample_every = sample_every
+        # Indexed by instruction id (see instructions.INSTRUCTION_NAMES)
+        self.counts = [0] * len(INSTRUCTION_NAMES)
+        self.sampled_ns = [0] * len(INSTRUCTION_NAMES)
+        self.samples = [0] * len(INSTRUCTION_NAMES)
+
+    def count(self, inst_id):
+        """Counts one execution of an instruction. Returns True if this execution should be timed"""
+        count = self.counts[inst_id] + 1
+        self.counts[inst_id] = count
+        return self.sample_every > 0 and count % self.sample_every == 0
+
+    def add_sample(self, inst_id, ns):
+        self.sampled_ns[inst_id] += ns
+        self.samples[inst_id] += 1
+
+    def mean_ns(self, inst_id):
+        """Mean host time of an instruction in nanoseconds, or None if it was never timed"""
+        if self.samples[inst_id] == 0:
+            return None
+        return self.sampled_ns[inst_id] / self.samples[inst_id]
+
+    def total(self):
+        return sum(self.counts)
+
+    def as_dict(self):
+        """Returns {instruction name: {'count': ..., 'mean_ns': ...}} for the instructions that were executed"""
+        return {name: {'count': self.counts[inst_id], 'mean_ns': self.mean_ns(inst_id)}
+                for inst_id, name in enumerate(INSTRUCTION_NAMES) if self.counts[inst_id]}
+
+    def summary(self):
+        """Returns a text table of the executed instructions, most executed first
+
+        The estimated time is the count times the mean sampled time, i.e. an estimate of the host time spent in each
+        instruction kind.
+        """
+        total = self.total()
+        lines = ['{:<12} {:>12} {:>7} {:>10} {:>12}'.format('instruction', 'count', '%', 'mean ns', 'est. ms')]
+        for inst_id in sorted(range(len(INSTRUCTION_NAMES)), key=lambda i: self.counts[i], reverse=True):
+            count = self.counts[inst_id]
+            if count == 0:
+                continue
+            mean = self.mean_ns(inst_id)
+            lines.append('{:<12} {:>12} {:>7.2f} {:>10} {:>12}'.format(
+                INSTRUCTION_NAMES[inst_id], count, 100 * count / total,
+                '-' if mean is None else '{:.0f}'.format(mean),
+                '-' if mean is None else '{:.2f}'.format(count * mean / 1e6)))
+        lines.append('{:<12} {:>12}'.format('total', total))
+        return '\n'.join(lines)
@@ -0,0 +1,248 @@
+"""Serves the emulator over TCP: streams delta encoded frames to thin clients and takes their keypad back
+
+Usage: python stream_server.py ROM [--host HOST] [--port PORT] [--ips N] [--seconds S] [--seed N]
+       python stream_server.py ROM --loopback [--seconds S] [--ips N] [--keys KEYS]
+
+Every connection gets a session of its own (see async_host.Session), run headless in real time. The first form serves
+until interrupted, the second one runs a server and a client in the same process for S seconds, pressing KEYS (a comma
+separated list of hex keys) in turn, then checks that the client ended with the framebuffer of the server and
+reports how many bytes the stream took per frame.
+
+Protocol (little endian). The server starts with a '<4sBBB' hello (magic C8FS, version, width and height of the
+display in pixels). Then, every time the display changes, it sends a frame as a '<II' header (frame count, mask of the
+changed rows, bit r set if row r changed) followed by the 8 bytes of every changed row from top to bottom (packed as
+in Chip8State.framebuffer_bytes). A frame is a delta against the previous frame sent, the first one against a blank
+display, so a static screen sends nothing and a moving sprite only its rows. The client sends the keypad as '<H'
+masks (bit k set if key k is pressed) whenever it changes.
+
+A client that reads slower than the frames come only receives the latest display, in one delta against the last frame
+it got.
+"""
+import argparse
+import asyncio
+import struct
+
+from async_host import Host, Session, feed, frames_of
+from chip8 import Chip8State
+from roms import read_rom
+from scheduler import DEFAULT_INSTRUCTIONS_PER_SECOND
+
+STREAM_MAGIC = b'C8FS'
+STREAM_VERSION = 1
+_HELLO = struct.Struct('<4sBBB')
+_FRAME = struct.Struct('<II')
+_KEYS = struct.Struct('<H')
+ROW_BYTES = 8
+
+
+def encode_frame(previous, frame, frame_count):
+    """Returns the message of frame as a delta against previous (both packed displays), None if they are the same"""
+    rows = 0
+    changed = []
+    for row, start in enumerate(range(0, len(frame), ROW_BYTES)):
+        data = frame[start: start + ROW_BYTES]
+        if data != previous[start: start + ROW_BYTES]:
+            rows |= 1 << row
+            changed.append(data)
+    if not rows:
+        return None
+    return _FRAME.pack(frame_count & 0xFFFFFFFF, rows) + b''.join(changed)
+
+
+def apply_rows(framebuffer, rows, data):
+    """Copies the changed rows of a frame message (row mask and row bytes) into framebuffer (a bytearray)"""
+    offset = 0
+    row = 0
+    while rows:
+        if rows & 1:
+            start = row * ROW_BYTES
+            framebuffer[start: start + ROW_BYTES] = data[offset: offset + ROW_BYTES]
+            offset += ROW_BYTES
+        rows >>= 1
+        row += 1
+
+
+async def _read_keys(reader):
+    # Keypad masks sent by a client, until it disconnects
+    while True:
+        try:
+            data = await reader.readexactly(_KEYS.size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        yield _KEYS.unpack(data)[0]
+
+
+class StreamServer:
+    """Runs one session of a rom per connected client and streams its frames to it
+
+    seconds limits how long every session runs (None runs them until their client disconnects).
+    """
+
+    def __init__(self, rom_bytes, instructions_per_second=DEFAULT_INSTRUCTIONS_PER_SECOND, seconds=None, seed=None):
+        self.rom_bytes = rom_bytes
+        self.instructions_per_second = instructions_per_second
+        self.seconds = seconds
+        self.seed = seed
+        self.host = Host()
+        # Every session started, in the order of the connections
+        self.sessions = []
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Starts listening, port 0 picks a free port. Returns the (host, port) listened on"""
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.host.stop()
+
+    async def handle(self, reader, writer):
+        chip8 = Chip8State()
+        chip8.initialise(self.seed)
+        chip8.load_rom(self.rom_bytes)
+        session = Session(chip8, self.instructions_per_second, name=str(writer.get_extra_info('peername')))
+        self.sessions.append(session)
+        sink = session.add_sink()
+        writer.write(_HELLO.pack(STREAM_MAGIC, STREAM_VERSION, chip8.width, chip8.height))
+        running = self.host.start(session, self.seconds)
+        keys = asyncio.ensure_future(feed(session, _read_keys(reader)))
+        # The session ends with its client
+        keys.add_done_callback(lambda _: running.cancel())
+
+        previous = bytes(len(chip8.framebuffer_bytes()))
+        try:
+            async for frame_count, frame in frames_of(sink):
+                message = encode_frame(previous, frame, frame_count)
+                if message is None:
+                    continue
+                writer.write(message)
+                # Waits while the client is slow to read. Meanwhile the sink keeps only the latest frame
+                await writer.drain()
+                previous = frame
+                self.frames_sent += 1
+                self.bytes_sent += len(message)
+        except ConnectionError:
+            pass
+        finally:
+            running.cancel()
+            keys.cancel()
+            writer.close()
+
+
+class StreamClient:
+    """Client side of the stream: keeps the framebuffer up to date with the frames read and sends the keypad"""
+
+    def __init__(self, reader, writer, width, height):
+        self.reader = reader
+        self.writer = writer
+        self.width = width
+        self.height = height
+        self.framebuffer = bytearray(width * height // 8)
+        self.frame_count = 0
+        self.frames = 0
+        # Bytes of the frame messages read, not counting the hello
+        self.bytes_received = 0
+
+    @classmethod
+    async def connect(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        magic, version, width, height = _HELLO.unpack(await reader.readexactly(_HELLO.size))
+        if magic != STREAM_MAGIC or version != STREAM_VERSION:
+            writer.close()
+            raise ValueError('not a version {} frame stream'.format(STREAM_VERSION))
+        return cls(reader, writer, width, height)
+
+    async def read_frame(self):
+        """Reads the next frame into framebuffer. Returns False once the server has closed the stream"""
+        try:
+            header = await self.reader.readexactly(_FRAME.size)
+        except asyncio.IncompleteReadError:
+            return False
+        self.frame_count, rows = _FRAME.unpack(header)
+        size = ROW_BYTES * bin(rows).count('1')
+        apply_rows(self.framebuffer, rows, await self.reader.readexactly(size))
+        self.frames += 1
+        self.bytes_received += _FRAME.size + size
+        return True
+
+    async def send_keys(self, mask):
+        self.writer.write(_KEYS.pack(mask))
+        await self.writer.drain()
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def run_loopback(rom_bytes, seconds, instructions_per_second=DEFAULT_INSTRUCTIONS_PER_SECOND, keys=(1, 4),
+                       key_period=0.25, seed=None):
+    """Serves rom_bytes for seconds to a client in the same process, pressing keys in turn for key_period seconds
+    each. Returns the server, the client and whether the client ended with the framebuffer of the server"""
+    server = StreamServer(rom_bytes, instructions_per_second, seconds, seed)
+    host, port = await server.start()
+    client = await StreamClient.connect(host, port)
+
+    async def press_keys():
+        for i in range(int(seconds / key_period)):
+            await client.send_keys(1 << keys[i % len(keys)] if i % 2 == 0 else 0)
+            await asyncio.sleep(key_period)
+
+    pressing = asyncio.ensure_future(press_keys())
+    while await client.read_frame():
+        pass
+    pressing.cancel()
+    matches = bytes(client.framebuffer) == server.sessions[0].chip8.framebuffer_bytes()
+    await client.close()
+    await server.close()
+    return server, client, matches
+
+
+async def serve(rom_bytes, host, port, instructions_per_second, seconds, seed):
+    server = StreamServer(rom_bytes, instructions_per_second, seconds, seed)
+    host, port = await server.start(host, port)
+    print('serving on {}:{}'.format(host, port))
+    async with server.server:
+        await server.server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream a CHIP-8 rom to TCP clients')
+    parser.add_argument('rom', help='path to a rom or name of one of the roms in ROMS/')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8008, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--ips', type=int, default=DEFAULT_INSTRUCTIONS_PER_SECOND,
+                        help='emulated instructions per second (default: %(default)s)')
+    parser.add_argument('--seconds', type=float, help='end every session after this many seconds')
+    parser.add_argument('--seed', type=int, help='seed of the random number generator of every session')
+    parser.add_argument('--loopback', action='store_true', help='run a client in this process and check its frames')
+    parser.add_argument('--keys', default='1,4', help='hex keys pressed in turn by the loopback client '
+                                                      '(default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    rom_bytes = read_rom(args.rom)
+    if not args.loopback:
+        try:
+            asyncio.run(serve(rom_bytes, args.host, args.port, args.ips, args.seconds, args.seed))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    seconds = args.seconds or 5.0
+    keys = tuple(int(key, 16) for key in args.keys.split(','))
+    server, client, matches = asyncio.run(run_loopback(rom_bytes, seconds, args.ips, keys, seed=args.seed))
+    emulated = server.sessions[0].scheduler.frame_count
+    print('{} emulated frames, {} sent ({} bytes, {:.1f} bytes per sent frame, {:.1f} per emulated frame; '
+          'full frames would take {} bytes)'.format(
+              emulated, client.frames, client.bytes_received, client.bytes_received / max(client.frames, 1),
+              client.bytes_received / max(emulated, 1), emulated * len(client.framebuffer)))
+    print('client framebuffer matches the server: {}'.format(matches))
+    if not matches:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
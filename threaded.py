@@ -0,0 +1,109 @@
+"""Runs the emulation on its own thread, apart from the front end that presents the frames and reads the keyboard
+
+The cpu thread (EmulatorThread) paces itself at 60 Hz, emulates the frames due and publishes the display into a double
+buffered FrameBuffer whenever it changes. The front end thread takes the latest published frame whenever it is ready to
+present one, so slow presentation (scaling the window, waiting for the display) never holds up the emulation and a slow
+frame of emulation never holds up the window: each side only ever waits for the other to swap two buffers.
+
+The keypad and the rewind key go the other way as plain attributes of the EmulatorThread, read by the cpu thread once
+per frame. Storing an int or a bool is atomic in CPython, so this needs no lock.
+
+The threads share the interpreter lock, so pure python emulation and presentation still take turns on one core; what
+the split buys is that neither waits on the other's pacing. pygame releases the lock while it scales and flips.
+"""
+import threading
+
+from scheduler import TIMER_HZ, Pacer
+
+
+class FrameBuffer:
+    """Double buffer of the packed display (see Chip8State.framebuffer_bytes), one writer and any number of readers
+
+    The writer fills the back buffer without the lock and only takes it to swap the buffers. Readers copy the front
+    buffer out under the lock, 256 bytes at most once per presented frame.
+    """
+
+    def __init__(self, size=256):
+        self._front = bytearray(size)
+        self._back = bytearray(size)
+        self._lock = threading.Lock()
+        # Number of frames published so far
+        self.generation = 0
+
+    def publish(self, frame):
+        """Makes frame (bytes of the display) the latest frame"""
+        back = self._back
+        back[:] = frame
+        with self._lock:
+            self._back, self._front = self._front, back
+            self.generation += 1
+
+    def latest(self, since=-1):
+        """Returns (generation, frame) of the latest frame, or None if no frame was published after generation since"""
+        # Reading the int is atomic: a stale value only means the frame is picked up on the next call
+        if self.generation == since:
+            return None
+        with self._lock:
+            return self.generation, bytes(self._front)
+
+
+class EmulatorThread(threading.Thread):
+    """Runs a scheduler (see scheduler.Scheduler) on its own thread, in real time
+
+    The front end sets keypad_mask (the 16 bit mask of the pressed keys) and rewinding (True while the rewind key is
+    held, when a rewind_buffer is given), and reads the frames from the frames attribute (a FrameBuffer). The chip8 is
+    owned by this thread until stop returns.
+    """
+
+    def __init__(self, scheduler, pacing='sleep', rewind_buffer=None, recording=None):
+        super().__init__(name='chip8-cpu', daemon=True)
+        self.scheduler = scheduler
+        self.chip8 = scheduler.chip8
+        # Paces the emulated frames on real time, independently of the frames presented by the front end
+        self.pacer = Pacer(TIMER_HZ, pacing)
+        # Records the state of every emulated frame and plays them backwards while rewinding
+        self.rewind_buffer = rewind_buffer
+        # recording.InputRecording the keypad changes are recorded in, if any
+        self.recording = recording
+        self.frames = FrameBuffer()
+        self.keypad_mask = 0
+        self.rewinding = False
+        # Exception that ended the thread, if any
+        self.error = None
+        self._stopping = threading.Event()
+
+    def run(self):
+        chip8 = self.chip8
+        scheduler = self.scheduler
+        rewind_buffer = self.rewind_buffer
+        recording = self.recording
+        if rewind_buffer is not None:
+            rewind_buffer.record(chip8)
+        # Display generation last published, -1 so that the first frame is always published
+        published_generation = -1
+        try:
+            while not self._stopping.is_set():
+                elapsed = self.pacer.wait()
+                if self.rewinding and rewind_buffer is not None:
+                    rewind_buffer.rewind(chip8)
+                else:
+                    chip8.set_keypad_mask(self.keypad_mask)
+                    if recording is not None:
+                        recording.record(chip8)
+                    if scheduler.advance(elapsed) and rewind_buffer is not None:
+                        rewind_buffer.record(chip8)
+                if chip8.display_generation != published_generation:
+                    self.frames.publish(chip8.framebuffer_bytes())
+                    published_generation = chip8.display_generation
+        except Exception as error:
+            # Kept for the front end, which finds the thread dead (see is_alive)
+            self.error = error
+            raise
+
+    def stop(self):
+        """Stops the thread and waits for it to end. Re-raises the exception that ended it, if any"""
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+        if self.error is not None:
+            raise self.error
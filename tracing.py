@@ -0,0 +1,123 @@
+"""Execution tracing into a fixed size ring buffer of packed binary records
+
+Enable it on a Chip8State by setting its tracer (chip8.tracer = TraceBuffer(4096)). Every executed instruction then
+stores its pc and opcode, and optionally the registers it changed, overwriting the oldest records once the buffer is
+full. When no tracer is set Chip8State.run doesn't even check for one per instruction.
+
+The buffer can be dumped to a file and decoded back to text later:
+
+    python tracing.py TRACE_FILE [--last N]
+"""
+import argparse
+import struct
+
+from instructions import get_instruction_name
+
+# Dump file header: magic, format version, flags, record count
+_HEADER = struct.Struct('<4sBBI')
+_MAGIC = b'C8TR'
+_VERSION = 1
+_FLAG_REGISTERS = 0x01
+
+# pc, opcode
+_RECORD = struct.Struct('<HH')
+# pc, opcode, mask of the V registers changed by the instruction (bit k for Vk), the 16 V registers and I after it
+_REGISTERS_RECORD = struct.Struct('<HHH16sH')
+
+
+class TraceBuffer:
+    def __init__(self, capacity=4096, registers=False):
+        self.capacity = capacity
+        # Also record the registers changed by every instruction (slower, records are 24 instead of 4 bytes)
+        self.registers = registers
+        self._record = _REGISTERS_RECORD if registers else _RECORD
+        self._buffer = bytearray(capacity * self._record.size)
+        # Next record to write and total number of records written
+        self._position = 0
+        self.count = 0
+
+    def record(self, pc, opcode, registers_before=None, chip8=None):
+        """Stores one executed instruction
+
+        With register recording enabled, registers_before are the V registers before the instruction and chip8 is
+        the machine after it (or where it stopped, for an instruction that failed).
+        """
+        offset = self._position * self._record.size
+        if self.registers:
+            registers_after = bytes(chip8.gen_regs)
+            changed = 0
+            for reg in range(16):
+                if registers_before[reg] != registers_after[reg]:
+                    changed |= 1 << reg
+            self._record.pack_into(self._buffer, offset, pc, opcode, changed, registers_after, chip8.index_reg)
+        else:
+            self._record.pack_into(self._buffer, offset, pc, opcode)
+        self._position += 1
+        if self._position == self.capacity:
+            self._position = 0
+        self.count += 1
+
+    def records(self):
+        """Returns the records in the buffer from oldest to newest, as tuples of the packed fields"""
+        stored = min(self.count, self.capacity)
+        first = (self._position - stored) % self.capacity
+        size = self._record.size
+        return [self._record.unpack_from(self._buffer, ((first + i) % self.capacity) * size) for i in range(stored)]
+
+    def clear(self):
+        self._position = 0
+        self.count = 0
+
+    def dump(self, path):
+        """Writes the records (oldest first) to a file that load_trace can read"""
+        records = self.records()
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, _FLAG_REGISTERS if self.registers else 0, len(records)))
+            for record in records:
+                f.write(self._record.pack(*record))
+
+
+def load_trace(path):
+    """Reads a trace dump. Returns (registers, records) where registers tells if the records hold register diffs"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, flags, count = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError('{} is not a version {} trace dump'.format(path, _VERSION))
+    registers = bool(flags & _FLAG_REGISTERS)
+    record = _REGISTERS_RECORD if registers else _RECORD
+    return registers, [record.unpack_from(data, _HEADER.size + i * record.size) for i in range(count)]
+
+
+def format_record(record, registers=False):
+    pc, opcode = record[0], record[1]
+    try:
+        inst_name = get_instruction_name(opcode)
+    except ValueError:
+        inst_name = '???'
+    line = '{:03x}: {:04x} {:<10}'.format(pc, opcode, inst_name)
+    if registers:
+        changed, values, index = record[2], record[3], record[4]
+        diff = ['V{:X}={:02x}'.format(reg, values[reg]) for reg in range(16) if changed & (1 << reg)]
+        line += ' I={:03x} {}'.format(index, ' '.join(diff))
+    return line.rstrip()
+
+
+def format_trace(records, registers=False):
+    return '\n'.join(format_record(record, registers) for record in records)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print a CHIP-8 trace dump as text')
+    parser.add_argument('trace', help='trace dump written by TraceBuffer.dump')
+    parser.add_argument('--last', type=int, help='only print the last N instructions')
+    args = parser.parse_args(argv)
+
+    registers, records = load_trace(args.trace)
+    if args.last is not None:
+        records = records[-args.last:]
+    print(format_trace(records, registers))
+
+
+if __name__ == '__main__':
+    main()
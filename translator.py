@@ -0,0 +1,495 @@
+"""Executes a Chip8State by translating the hot parts of guest code into Python functions
+
+Code is first run by the Chip8State interpreter, and the start address of every run of straight-line code (the address
+execution lands on after a jump, call, return or skip) is counted. Once an address has been reached HOT_THRESHOLD
+times, it is translated into a region: the block of code starting there, and the blocks it can go to next that have
+already run, linked together in one Python function. Within a region the registers stay in local variables and going
+from one block to the next is a comparison of the pc, so execution only goes back to the engine when it leaves the
+region (or at the end of the batch). Each region is compiled once and cached by its start address.
+
+A block starts at some address and follows the straight-line code from there, up to the start of another block (an
+address the pc lands on after a branch):
+
+- An unconditional jump doesn't end a block, translation simply continues at its target (unless the target is already
+  part of the block or starts another one: then the block ends and goes there).
+- A skip whose next instruction is a plain instruction becomes an if around that instruction. A skip followed by a
+  jump becomes an if that leaves the block at the jump target. Any other skip ends the block.
+- Calls and returns end the block.
+- DRW draws the sprite rows straight into the display, without going through the registers of the Chip8State.
+
+Idle loops (see Chip8State.run) are not run at all when a region is entered at one of their instructions: the rest of
+the batch is skipped.
+
+The generated code checks the cycle budget when it enters a block, and only runs the block if all of it fits, so the
+engine runs exactly as many instructions as asked (the timers tick between batches, so this keeps them exact). The
+end of a batch that is too short for the next block is run by the interpreter.
+
+A few instructions are never translated (LD_Vx_K, LD_B_Vx, LD_I_Vx, SYS, JP_V0 and invalid opcodes): a block stops
+right before them and they are executed by the Chip8State interpreter. LD_B_Vx and LD_I_Vx are the only instructions
+that write to memory. The translator is the code_cache of its Chip8State, so whenever one of them runs (instrumented
+or not), the regions that cover the written bytes are dropped from the cache and get translated again from the new
+code the next time they are hot. Loading a rom or restoring a snapshot drops all of them.
+"""
+import re
+from collections import namedtuple
+
+from chip8 import BLANK_DISPLAY, ROW_MASK
+from instructions import INSTRUCTION_IDS, INSTRUCTION_NAMES
+
+# function(chip8, budget) runs the region from the pc, going from block to block as long as the pc stays in it and the
+# next block fits in what is left of budget instructions. It returns the number of instructions executed (0 if the
+# first block doesn't fit). length is the number of instructions translated into it.
+Block = namedtuple('Block', ['function', 'length'])
+
+# Number of times the code at an address is run by the interpreter before it is translated. Code that only runs a few
+# times (start up, a title screen) is not worth compiling
+HOT_THRESHOLD = 32
+# Largest number of instructions translated into a block
+MAX_BLOCK_LENGTH = 64
+# Largest number of skips followed by a jump in a block (each one nests the rest of the block one level deeper)
+MAX_BLOCK_EXITS = 16
+# Largest number of blocks linked into a region
+MAX_REGION_BLOCKS = 32
+
+# Instructions executed by the interpreter instead of being translated
+_INTERPRETED = {INSTRUCTION_IDS[name] for name in ('LD_Vx_K', 'LD_B_Vx', 'LD_I_Vx', 'SYS', 'JP_V0')}
+# Instructions after which the interpreter does not go on to the next address
+_BRANCHES = {INSTRUCTION_IDS[name] for name in ('JP', 'CALL', 'RET', 'SE_Vx', 'SNE_Vx', 'SE_Vy_Vy', 'SNE_Vx_Vy',
+                                                'SKP_Vx', 'SKNP_Vx')}
+_JP = INSTRUCTION_IDS['JP']
+_LD_VX_I = INSTRUCTION_IDS['LD_Vx_I']
+
+# Python code of every plain (not control flow) instruction, with the registers it reads and writes ('x' for Vx, 'y'
+# for Vy and 'f' for VF). In the code {x} and {y} are the register numbers (the locals v{x} and v{y} hold the
+# registers) and {n}, {kk} and {nnn} the operands. Each line has the same effect as the Chip8State handler of the
+# instruction, in the same order (which matters when x or y is 15). LD_Vx_I is generated separately as it touches a
+# variable number of registers. DRW calls _draw with the sprite rows.
+_TEMPLATES = {
+    'CLS': (['display[:] = BLANK_DISPLAY', 'chip8.display_generation += 1'], '', ''),
+    'LD_Vx': (['v{x} = {kk}'], '', 'x'),
+    'ADD_Vx': (['v{x} = (v{x} + {kk}) & 0xFF'], 'x', 'x'),
+    'LD_Vx_Vy': (['v{x} = v{y}'], 'y', 'x'),
+    'OR_Vx_Vy': (['v{x} = v{x} | v{y}'], 'xy', 'x'),
+    'AND_Vx_Vy': (['v{x} = v{x} & v{y}'], 'xy', 'x'),
+    'XOR_Vx_Vy': (['v{x} = v{x} ^ v{y}'], 'xy', 'x'),
+    'ADD_Vx_Vy': (['t = v{x} + v{y}', 'v{x} = t & 0xFF', 'v15 = 1 if t > 0xFF else 0'], 'xy', 'xf'),
+    'SUB_Vx_Vy': (['v15 = 1 if v{x} > v{y} else 0', 'v{x} = (v{x} - v{y}) & 0xFF'], 'xy', 'xf'),
+    'SHR_Vx_Vy': (['v15 = v{x} & 0b1', 'v{x} = v{x} >> 1'], 'x', 'xf'),
+    'SUBN_Vx_Vy': (['v15 = 1 if v{y} > v{x} else 0', 'v{x} = (v{y} - v{x}) & 0xFF'], 'xy', 'xf'),
+    'SHL_Vx_Vy': (['v15 = v{x} >> 7', 'v{x} = (v{x} << 1) & 0xFF'], 'x', 'xf'),
+    'LD_I': (['index = {nnn}'], '', ''),
+    'RND_Vx': (['v{x} = chip8.rng.getrandbits(8) & {kk}'], '', 'x'),
+    'DRW_Vx_Vy': (['v15 = draw(display, memory[index: index + {n}], v{x}, v{y})',
+                   'chip8.display_generation += 1'], 'xy', 'f'),
+    'LD_Vx_DT': (['v{x} = chip8.delay_timer'], '', 'x'),
+    'LD_DT_Vx': (['chip8.delay_timer = v{x}'], 'x', ''),
+    'LD_ST_Vx': (['chip8.sound_timer = v{x}'], 'x', ''),
+    'ADD_I_Vx': (['index = (index + v{x}) & 0xFFFF'], 'x', ''),
+    'LD_F_Vx': (['index = chip8.fontset_loc + v{x} * 5'], 'x', ''),
+}
+# Condition under which each skip instruction skips the next instruction, with the registers it reads
+_SKIPS = {
+    'SE_Vx': ('v{x} == {kk}', 'x'),
+    'SNE_Vx': ('v{x} != {kk}', 'x'),
+    'SE_Vy_Vy': ('v{x} == v{y}', 'xy'),
+    'SNE_Vx_Vy': ('v{x} != v{y}', 'xy'),
+    'SKP_Vx': ('chip8.keypad[v{x}] == 1', 'x'),
+    'SKNP_Vx': ('chip8.keypad[v{x}] != 1', 'x'),
+}
+# Calls and returns. They end a block by assigning the address of the next instruction to the local pc
+_CALLS = {
+    'CALL': ['chip8.sp_reg += 1', 'chip8.stack[chip8.sp_reg] = {next}', 'pc = {nnn}'],
+    'RET': ['pc = chip8.stack[chip8.sp_reg]', 'chip8.sp_reg -= 1'],
+}
+
+
+def _draw(display, sprite, x, y):
+    # Chip8State._drw_vx_vy with the width and height (64 and 32) folded in: draws the sprite rows (bytes) at (x, y)
+    # and returns the new VF
+    collision = 0
+    row = y & 31
+    shift = 56 - (x & 63)
+    if shift >= 0:
+        for byte in sprite:
+            bits = byte << shift
+            old = display[row]
+            collision |= old & bits
+            display[row] = old ^ bits
+            row = (row + 1) & 31
+    else:
+        # The sprite crosses the right edge, the pixels that go past it wrap around to the left edge
+        for byte in sprite:
+            bits = (byte >> -shift) | ((byte << (64 + shift)) & ROW_MASK)
+            old = display[row]
+            collision |= old & bits
+            display[row] = old ^ bits
+            row = (row + 1) & 31
+    return 1 if collision else 0
+
+
+class BlockTranslator:
+    """Runs a Chip8State through translated regions. Has the same run(cycles) interface as Chip8State"""
+
+    def __init__(self, chip8, hot_threshold=HOT_THRESHOLD):
+        self.chip8 = chip8
+        self.hot_threshold = hot_threshold
+        # Translated regions by the start address of each of their blocks (a region can be entered at any of them).
+        # None marks an address whose instruction is interpreted
+        self.blocks = {}
+        # Number of times the interpreter ran the code at each address that is not translated yet
+        self._counts = {}
+        # Start addresses of the blocks and addresses of the instructions translated into each cached region, by
+        # region start address
+        self._region_starts = {}
+        self._block_addresses = {}
+        # Start addresses of the cached regions that cover each memory address, used to invalidate them
+        self._covering = [set() for _ in range(len(chip8.memory))]
+        # (loop start, address of the closing jump) of the short loops that may be idle, by the start address of the
+        # blocks inside them
+        self._idle_loops = {}
+        # The chip8 drops the translated code when its memory is written to, or replaced (see Chip8State.code_cache)
+        chip8.code_cache = self
+
+    def run(self, cycles):
+        """Executes the given number of instructions"""
+        chip8 = self.chip8
+        if chip8.is_instrumented():
+            chip8.run(cycles)
+            return
+        if chip8.key_wait is not None and chip8.waiting_for_key():
+            chip8.cycle_count += cycles
+            return
+
+        blocks = self.blocks
+        counts = self._counts
+        remaining = cycles
+        while remaining > 0:
+            pc = chip8.pc_reg
+            block = blocks.get(pc, False)
+            if block is False:
+                count = counts.get(pc, 0) + 1
+                if count < self.hot_threshold:
+                    # Not hot yet: the interpreter runs the code up to the next branch
+                    counts[pc] = count
+                    block = None
+                else:
+                    block = self.translate(pc)
+            loop = self._idle_loops.get(pc)
+            if loop is not None and chip8._is_idle_loop(loop[0], loop[1], pc == loop[0]):
+                # Same as Chip8State.run: the rest of the cycles go around the loop, one instruction each
+                start, jump = loop
+                position = (pc - start) // 2 + remaining
+                chip8.pc_reg = start + 2 * (position % ((jump - start) // 2 + 1))
+                chip8.cycle_count += remaining
+                return
+            if block is not None:
+                executed = block[0](chip8, remaining)
+                if executed:
+                    chip8.cycle_count += executed
+                    remaining -= executed
+                    continue
+                # The block at the pc is longer than the rest of the batch
+            remaining -= self._interpret_run(remaining)
+            if chip8.key_wait is not None:
+                # LD_Vx_K started waiting for a key, the rest of the cycles pass idle
+                chip8.cycle_count += remaining
+                return
+
+    def invalidate(self, start, end):
+        """Drops the cached regions that cover any address in [start, end). The chip8 calls it after memory writes"""
+        for address in range(max(start, 0), min(end, len(self._covering))):
+            for region in list(self._covering[address]):
+                self._drop(region)
+            if self.blocks.get(address, False) is None:
+                del self.blocks[address]
+
+    def invalidate_all(self):
+        """Drops every cached region. The chip8 calls it when its whole memory may have changed"""
+        self.blocks.clear()
+        self._counts.clear()
+        self._idle_loops.clear()
+        self._region_starts.clear()
+        self._block_addresses.clear()
+        for covering in self._covering:
+            covering.clear()
+
+    def _drop(self, region):
+        for start in self._region_starts.pop(region):
+            del self.blocks[start]
+            self._idle_loops.pop(start, None)
+        for covered in self._block_addresses.pop(region):
+            self._covering[covered].discard(region)
+            self._covering[covered + 1].discard(region)
+
+    def translate(self, start):
+        """Translates the region starting at start, caches it and returns it (or None if it has no instructions)"""
+        memory = self.chip8.memory
+        decode_table = self.chip8._get_decode_table()
+        blocks = self.blocks
+        counts = self._counts
+
+        # The block at start, then the blocks it goes to that have already run and are not part of another region,
+        # breadth first
+        leaders = set(counts) | set(blocks)
+        builders = []
+        starts = [start]
+        while len(builders) < len(starts) and len(builders) < MAX_REGION_BLOCKS:
+            builder = _BlockBuilder(memory, decode_table, starts[len(builders)], leaders)
+            builder.translate()
+            if not builder.addresses:
+                if not builders:
+                    blocks[start] = None
+                    return None
+                # An interpreted instruction: it stays outside of the region
+                starts.pop(len(builders))
+                continue
+            builders.append(builder)
+            for successor in sorted(builder.successors):
+                if successor in counts and successor not in starts:
+                    starts.append(successor)
+        starts = starts[:len(builders)]
+
+        name = 'region_{:03x}'.format(start)
+        namespace = {'BLANK_DISPLAY': BLANK_DISPLAY, 'draw': _draw}
+        exec(compile(_region_source(name, builders), '<chip8 region 0x{:03x}>'.format(start), 'exec'), namespace)
+
+        addresses = sorted({address for builder in builders for address in builder.addresses})
+        block = Block(namespace[name], len(addresses))
+        for block_start in starts:
+            blocks[block_start] = block
+            counts.pop(block_start, None)
+            loop = _find_idle_loop(memory, block_start)
+            if loop is not None:
+                self._idle_loops[block_start] = loop
+        self._region_starts[start] = starts
+        self._block_addresses[start] = addresses
+        for covered in addresses:
+            # Both bytes of every instruction
+            self._covering[covered].add(start)
+            self._covering[covered + 1].add(start)
+        return block
+
+    def _interpret_run(self, cycles):
+        # Runs the code at the pc in the interpreter up to and including the next branch (at most cycles
+        # instructions), or only the instruction at the pc if it is one of the interpreted ones. Returns the number of
+        # cycles used
+        chip8 = self.chip8
+        memory = chip8.memory
+        decode_table = chip8._get_decode_table()
+        address = chip8.pc_reg
+        length = 0
+        while length < cycles and address + 1 < len(memory):
+            entry = decode_table[(memory[address] << 8) | memory[address + 1]]
+            if entry is None or entry[0] in _INTERPRETED:
+                break
+            length += 1
+            if entry[0] in _BRANCHES:
+                break
+            address += 2
+        if length == 0:
+            # Memory writes drop the regions they cover through the chip8 (see Chip8State.code_cache)
+            chip8.run(1)
+            return 1
+        chip8.run(length)
+        return length
+
+
+def _uses(templates, local):
+    # True if a local variable of the region function appears in the lines of templates
+    return any(re.search(r'\b{}\b'.format(local), line) for line in templates)
+
+
+def _find_idle_loop(memory, start):
+    # (loop start, jump) if the instruction at start is in a loop closed by a jump back over at most 2 instructions,
+    # to start or before it. Chip8State checks the rest of the loop when it is entered
+    for jump in range(start, min(start + 6, len(memory) - 1), 2):
+        opcode = (memory[jump] << 8) | memory[jump + 1]
+        target = opcode & 0x0FFF
+        if opcode & 0xF000 == 0x1000 and jump - 4 <= target <= start and (jump - target) % 2 == 0:
+            return target, jump
+    return None
+
+
+def _region_source(name, builders):
+    """Returns the source of the function running the blocks of builders"""
+    read = set()
+    written = set()
+    for builder in builders:
+        read |= builder.read
+        written |= builder.written
+    uses_index = any(builder.uses_index for builder in builders)
+
+    body = []
+    if read or written:
+        body.append('regs = chip8.gen_regs')
+    # Registers are loaded into locals on entry and the ones written are stored back on exit. Every written register is
+    # loaded too, so that a register only written on some paths is still stored back correctly
+    body.extend('v{0} = regs[{0}]'.format(reg) for reg in sorted(read | written))
+    if uses_index:
+        body.append('index = chip8.index_reg')
+    if any(builder.uses_memory for builder in builders):
+        body.append('memory = chip8.memory')
+    if any(builder.uses_display for builder in builders):
+        body.append('display = chip8.display')
+    body.append('executed = 0')
+    body.append('pc = chip8.pc_reg')
+    body.append('while True:')
+    _dispatch(body, sorted(builders, key=lambda builder: builder.start), 1)
+    body.extend('regs[{0}] = v{0}'.format(reg) for reg in sorted(written))
+    if uses_index:
+        body.append('chip8.index_reg = index')
+    body.append('chip8.pc_reg = pc')
+    body.append('return executed')
+    return 'def {}(chip8, budget):\n    {}\n'.format(name, '\n    '.join(body))
+
+
+def _dispatch(body, builders, indent):
+    # Appends the code going to the block of builders (sorted by start address) the pc is at, or out of the region if
+    # it is at none of them: a binary search on the pc down to a few blocks, then compared one by one
+    prefix = '    ' * indent
+    if len(builders) > 4:
+        middle = len(builders) // 2
+        body.append('{}if pc < {}:'.format(prefix, builders[middle].start))
+        _dispatch(body, builders[:middle], indent + 1)
+        body.append('{}else:'.format(prefix))
+        _dispatch(body, builders[middle:], indent + 1)
+        return
+    for i, builder in enumerate(builders):
+        body.append('{}{} pc == {}:'.format(prefix, 'if' if i == 0 else 'elif', builder.start))
+        # The whole block has to fit in the budget, otherwise the engine interprets the rest of the batch
+        body.append('{}    if executed + {} > budget:'.format(prefix, len(builder.addresses)))
+        body.append('{}        break'.format(prefix))
+        body.extend('{}    {}{}'.format(prefix, '    ' * line_indent, line) for line_indent, line in builder.lines)
+    body.append('{}else:'.format(prefix))
+    body.append('{}    break'.format(prefix))
+
+
+class _BlockBuilder:
+    """Generates the Python code of the block starting at an address, as lines of a region function
+
+    The block stops at the addresses in leaders (the start addresses of other blocks), going on in the block there.
+    """
+
+    def __init__(self, memory, decode_table, start, leaders=()):
+        self.memory = memory
+        self.decode_table = decode_table
+        self.start = start
+        self.leaders = leaders
+        # Addresses of the translated instructions. A run of the block executes each of them at most once
+        self.addresses = []
+        # Addresses the block can go to next (not counting the ones only known at run time, like returns)
+        self.successors = set()
+        # Lines of the block as (indent level, code). They leave the next address in pc
+        self.lines = []
+        self.read = set()
+        self.written = set()
+        self.uses_index = False
+        self.uses_memory = False
+        self.uses_display = False
+
+    def _decode(self, address):
+        if address + 1 >= len(self.memory):
+            return None
+        return self.decode_table[(self.memory[address] << 8) | self.memory[address + 1]]
+
+    @staticmethod
+    def _is_plain(entry):
+        return entry is not None and (entry[0] == _LD_VX_I or INSTRUCTION_NAMES[entry[0]] in _TEMPLATES)
+
+    def _use(self, entry, reads, writes):
+        registers = {'x': entry[1], 'y': entry[2], 'f': 15}
+        self.read.update(registers[reg] for reg in reads)
+        self.written.update(registers[reg] for reg in writes)
+
+    def _emit(self, indent, templates, entry, next_address=None):
+        inst_id, x, y, n, kk, nnn = entry
+        for line in templates:
+            self.lines.append((indent, line.format(x=x, y=y, n=n, kk=kk, nnn=nnn, next=next_address)))
+
+    def _emit_plain(self, indent, entry):
+        x = entry[1]
+        if entry[0] == _LD_VX_I:
+            self.lines.extend((indent, 'v{0} = memory[index + {0}]'.format(i)) for i in range(x + 1))
+            self.written.update(range(x + 1))
+            self.uses_index = self.uses_memory = True
+            return
+        name = INSTRUCTION_NAMES[entry[0]]
+        templates, reads, writes = _TEMPLATES[name]
+        self._emit(indent, templates, entry)
+        self._use(entry, reads, writes)
+        self.uses_index = self.uses_index or _uses(templates, 'index')
+        self.uses_memory = self.uses_memory or _uses(templates, 'memory')
+        self.uses_display = self.uses_display or _uses(templates, 'display')
+
+    def _exit(self, indent, count, pc):
+        """Goes on at pc, with count instructions executed on this path"""
+        self.lines.append((indent, 'executed += {}'.format(count)))
+        self.lines.append((indent, 'pc = {}'.format(pc)))
+        self.successors.add(pc)
+
+    def translate(self):
+        # Instructions executed on the current path since the last update of the executed local. The ones run
+        # conditionally after a skip update it themselves
+        count = 0
+        indent = 0
+        exits = 0
+        address = self.start
+        while len(self.addresses) < MAX_BLOCK_LENGTH:
+            if address in self.addresses or (address != self.start and address in self.leaders):
+                # Another block (or this one again, for a loop) starts here
+                break
+            entry = self._decode(address)
+            if entry is None or entry[0] in _INTERPRETED:
+                break
+            name = INSTRUCTION_NAMES[entry[0]]
+            if entry[0] == _JP:
+                self.addresses.append(address)
+                count += 1
+                address = entry[5]
+                continue
+            if name in _CALLS:
+                self.addresses.append(address)
+                self._emit(indent, _CALLS[name], entry, address + 2)
+                self.lines.append((indent, 'executed += {}'.format(count + 1)))
+                if name == 'CALL':
+                    self.successors.add(entry[5])
+                return
+            if name in _SKIPS:
+                condition, reads = _SKIPS[name]
+                condition = condition.format(x=entry[1], y=entry[2], kk=entry[4])
+                self._use(entry, reads, '')
+                self.addresses.append(address)
+                count += 1
+                following = self._decode(address + 2)
+                if (following is not None and following[0] == _JP and exits < MAX_BLOCK_EXITS
+                        and address + 2 not in self.leaders):
+                    # Not skipping means jumping away: leave the block there, otherwise carry on after the jump
+                    self.addresses.append(address + 2)
+                    self.lines.append((indent, 'if not ({}):'.format(condition)))
+                    self._exit(indent + 1, count + 1, following[5])
+                    self.lines.append((indent, 'else:'))
+                    indent += 1
+                    exits += 1
+                    address += 4
+                    continue
+                if self._is_plain(following) and address + 2 not in self.leaders:
+                    # The next instruction only runs if not skipped
+                    self.addresses.append(address + 2)
+                    self.lines.append((indent, 'if not ({}):'.format(condition)))
+                    self._emit_plain(indent + 1, following)
+                    self.lines.append((indent + 1, 'executed += 1'))
+                    address += 4
+                    continue
+                self.lines.append((indent, 'executed += {}'.format(count)))
+                self.lines.append((indent, 'pc = {} if {} else {}'.format(address + 4, condition, address + 2)))
+                self.successors.update((address + 2, address + 4))
+                return
+            self._emit_plain(indent, entry)
+            self.addresses.append(address)
+            count += 1
+            address += 2
+
+        # Cut before another block, an interpreted instruction, or by the maximum length. Continue with the next
+        # instruction
+        if self.addresses:
+            self._exit(indent, count, address)